@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""asyncio counterparts to scriptharness.commands.
+
+These run the command with asyncio subprocesses, so an action can await
+many commands concurrently from a single thread.  Output goes through the
+same add_line()/add_lines() and OutputParser machinery as the blocking
+versions, and output_timeout and timeout are enforced with event loop
+timers rather than a polling loop.
+
+This module requires python 3.7+.
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from scriptharness.commands import Command, ParsedCommand, Output, \
+    SPOOL_SIZE
+from scriptharness.exceptions import ScriptHarnessError, \
+    ScriptHarnessFatal, ScriptHarnessTimeout
+from scriptharness.log import log_context
+from scriptharness.process import READ_SIZE, find_timeout, kill_runner
+import scriptharness.status
+import subprocess
+import time
+
+
+# Helper functions {{{1
+async def kill_process(process):
+    """Kill an asyncio subprocess and its children, and reap it.
+
+    Args:
+      process (asyncio.subprocess.Process): the process to kill.
+    """
+    kill_runner(process)
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def start_process(command, **kwargs):
+    """Start an asyncio subprocess.  This is the asyncio equivalent of
+    subprocess.Popen(command, **kwargs).
+
+    Args:
+      command (List[str] or str): the command to run.
+
+      **kwargs: sent to asyncio.create_subprocess_exec() or
+        asyncio.create_subprocess_shell(), depending on kwargs['shell'].
+
+    Returns:
+      asyncio.subprocess.Process: the running process.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessError: if we can't run the
+        command.
+    """
+    kwargs = dict(kwargs)
+    shell = kwargs.pop('shell', not isinstance(command, (list, tuple)))
+    kwargs.pop('bufsize', None)
+    try:
+        if shell:
+            if isinstance(command, (list, tuple)):
+                command = subprocess.list2cmdline(command)
+            return await asyncio.create_subprocess_shell(command, **kwargs)
+        return await asyncio.create_subprocess_exec(*command, **kwargs)
+    except OSError as exc_info:
+        raise ScriptHarnessError("Can't run command!", command, exc_info)
+
+
+async def watch_streams(logger, process, callbacks, max_timeout=None,
+                        output_timeout=None):
+    """The asyncio equivalent of scriptharness.process.watch_pipes().
+
+    Read each of the process' streams, sending each chunk of output to the
+    matching callback, until all streams hit EOF and the process exits.
+
+    Args:
+      logger (logging.Logger): the logger to use.
+
+      process (asyncio.subprocess.Process): the process to watch.
+
+      callbacks (Dict[asyncio.StreamReader, Callable[[bytes]]]): stream to
+        callback mapping.
+
+      max_timeout (Optional[int]): when specified, the process will be killed
+        if it takes longer than this number of seconds.  Default: None
+
+      output_timeout (Optional[int]): when specified, the process will be
+        killed if it doesn't produce any output for this number of seconds.
+        Default: None
+
+    Returns:
+      process.returncode (int): on non-timeout.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessTimeout: on output_timeout or
+        max_timeout.
+    """
+    times = {'start': time.time()}
+    times['last_output'] = times['start']
+
+    async def read_stream(stream, callback):
+        """Read from stream until EOF."""
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            if not chunk:
+                break
+            callback(chunk)
+            times['last_output'] = time.time()
+
+    async def wait_with_timeouts(future):
+        """Wait for future, killing the process if we hit a timeout."""
+        while True:
+            message, remaining = find_timeout(
+                times['start'], times['last_output'],
+                max_timeout=max_timeout, output_timeout=output_timeout
+            )
+            if message:
+                logger.error(message + "  Killing process...")
+                await kill_process(process)
+                raise ScriptHarnessTimeout(message)
+            done, _ = await asyncio.wait([future], timeout=remaining)
+            if done:
+                return future.result()
+
+    readers = asyncio.ensure_future(asyncio.gather(*[
+        read_stream(stream, callback)
+        for stream, callback in callbacks.items()
+    ]))
+    try:
+        await wait_with_timeouts(readers)
+        # The streams can close before the process exits.
+        return await wait_with_timeouts(
+            asyncio.ensure_future(process.wait())
+        )
+    finally:
+        if not readers.done():
+            readers.cancel()
+        if process.returncode is None:
+            await kill_process(process)
+
+
+# AsyncCommand {{{1
+class AsyncCommand(Command):
+    """Command, run as an asyncio subprocess.
+
+    Attributes:
+      + all of the attributes in scriptharness.commands.Command
+    """
+    async def run(self):  # pylint: disable=invalid-overridden-method
+        """Run the command.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessError on error
+        """
+        with log_context(command_id=self.command_id):
+            output_timeout, max_timeout = self.prepare_run()
+            splitter = self.get_splitter()
+            self.kwargs['stdout'] = subprocess.PIPE
+            self.kwargs['stderr'] = subprocess.STDOUT
+            process = await start_process(self.command, **self.kwargs)
+
+            def read_cb(chunk):
+                """Split the chunk into lines for add_lines()."""
+                lines = splitter.split(chunk)
+                if lines:
+                    self.add_lines(lines)
+
+            self.history['return_value'] = await watch_streams(
+                self.logger, process, {process.stdout: read_cb},
+                output_timeout=output_timeout, max_timeout=max_timeout
+            )
+            lines = splitter.flush()
+            if lines:
+                self.add_lines(lines)
+            self.history['status'] = self.detect_error_cb(self)
+            self.finish_process()
+            return self.history['status']
+
+
+# AsyncParsedCommand {{{1
+class AsyncParsedCommand(ParsedCommand, AsyncCommand):
+    """ParsedCommand, run as an asyncio subprocess.
+    """
+
+
+# AsyncOutput {{{1
+class AsyncOutput(Output):
+    """Output, run as an asyncio subprocess.
+
+    Attributes:
+      + all of the attributes in scriptharness.commands.Output
+    """
+    async def run(self):  # pylint: disable=invalid-overridden-method
+        """Run the command, writing stdout and stderr to the temp files.
+        """
+        with log_context(command_id=self.command_id):
+            output_timeout, max_timeout = self.prepare_run()
+            self.kwargs['stdout'] = subprocess.PIPE
+            self.kwargs['stderr'] = subprocess.PIPE
+            process = await start_process(self.command, **self.kwargs)
+            self.history['return_value'] = await watch_streams(
+                self.logger, process, {
+                    process.stdout: self.stdout.write,
+                    process.stderr: self.stderr.write,
+                }, output_timeout=output_timeout, max_timeout=max_timeout
+            )
+            self.history['status'] = self.detect_error_cb(self)
+            self.finish_process()
+            return self.history['status']
+
+
+# async_run {{{1
+async def async_run(command, cmd_class=AsyncCommand, halt_on_failure=False,
+                    **kwargs):
+    """Shortcut for running an AsyncCommand.  The asyncio equivalent of
+    scriptharness.commands.run().
+
+    Args:
+      command (List[str] or str): Command line to run.
+
+      cmd_class (Optional[AsyncCommand subclass]): the class to instantiate.
+        Defaults to AsyncCommand.
+
+      halt_on_failure (Optional[bool]): raise ScriptHarnessFatal on error
+        if True.  Default: False
+
+      **kwargs: kwargs for subprocess.
+
+    Returns:
+      AsyncCommand: the command object.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: on fatal error
+    """
+    message = ""
+    cmd = cmd_class(command, **kwargs)
+    try:
+        await cmd.run()
+        return cmd
+    except ScriptHarnessError as exc_info:
+        message = "error: %s" % exc_info
+        status = scriptharness.status.ERROR
+    except ScriptHarnessTimeout as exc_info:
+        message = "timeout: %s" % exc_info
+        status = scriptharness.status.TIMEOUT
+    if halt_on_failure and message:
+        raise ScriptHarnessFatal("Fatal %s" % message)
+    cmd.history.setdefault('status', status)
+    return cmd
+
+
+# async_parse {{{1
+async def async_parse(command, **kwargs):
+    """Shortcut for running an AsyncParsedCommand.  The asyncio equivalent
+    of scriptharness.commands.parse().
+
+    Args:
+      command (List[str] or str): Command line to run.
+
+      **kwargs: kwargs for async_run/AsyncParsedCommand.
+
+    Returns:
+      AsyncParsedCommand: the command object.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: on fatal error
+    """
+    return await async_run(command, cmd_class=AsyncParsedCommand, **kwargs)
+
+
+# async_get_output {{{1
+@asynccontextmanager
+async def async_get_output(command, halt_on_failure=False, **kwargs):
+    """Run command and yield the AsyncOutput cmd object.  The asyncio
+    equivalent of scriptharness.commands.get_output().
+
+    Usage::
+
+      async with async_get_output(command) as cmd:
+          output = cmd.get_output()
+
+    Args:
+      command (List[str] or str): the command to run.
+
+      halt_on_failure (Optional[bool]): raise ScriptHarnessFatal on error
+        if True.  Default: False
+
+      **kwargs: kwargs to send to AsyncOutput
+
+    Yields:
+      cmd (AsyncOutput)
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: when halt_on_failure is
+        True and we hit an error or timeout.
+    """
+    cmd = AsyncOutput(command, **kwargs)
+    status = scriptharness.status.SUCCESS
+    message = None
+    try:
+        await cmd.run()
+    except ScriptHarnessError as exc_info:
+        message = "error: %s" % exc_info
+        status = scriptharness.status.ERROR
+    except ScriptHarnessTimeout as exc_info:
+        message = "timeout: %s" % exc_info
+        status = scriptharness.status.TIMEOUT
+    if halt_on_failure and message:
+        cmd.cleanup()
+        raise ScriptHarnessFatal("Fatal %s" % message)
+    cmd.history.setdefault("status", status)
+    try:
+        yield cmd
+    finally:
+        cmd.cleanup()
+
+
+# async_get_text_output {{{1
+async def async_get_text_output(command, level=logging.INFO, **kwargs):
+    """Run command and return the stdout from that command.  The asyncio
+    equivalent of scriptharness.commands.get_text_output().
+
+    Args:
+      command (List[str] or str): the command to run.
+
+      level (int): logging level
+
+      **kwargs: kwargs to send to async_get_output.  spool_size defaults
+        to scriptharness.commands.SPOOL_SIZE.
+
+    Returns:
+      output (str): the stdout from the command.
+    """
+    kwargs.setdefault('spool_size', SPOOL_SIZE)
+    async with async_get_output(command, **kwargs) as cmd:
+        output = cmd.get_output()
+        cmd.logger.log(level, "Got output:")
+        for line in cmd.iter_lines():
+            cmd.logger.log(level, " {}".format(line.rstrip()))
+    return output
@@ -5,12 +5,19 @@
 Attributes:
   LOGGER_NAME (str): default logging.Logger name.
   STRINGS (Dict[str, Dict[str, str]]): Strings for logging.
+  COMMAND_IDS (itertools.count): source of unique Command.command_id values.
+  OUTPUT_CHUNK_SIZE (int): the default chunk size, in bytes, for
+    Output.iter_chunks().
+  SPOOL_SIZE (int): the default spool_size, in bytes, for get_text_output().
 """
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 from contextlib import contextmanager
 from copy import deepcopy
+import io
+import itertools
 import logging
+import mmap
 import multiprocessing
 import os
 import six
@@ -18,16 +25,22 @@ import pprint
 from scriptharness.errorlists import ErrorList
 from scriptharness.exceptions import ScriptHarnessError, \
     ScriptHarnessException, ScriptHarnessFatal, ScriptHarnessTimeout
-from scriptharness.log import OutputParser
+from scriptharness.log import BufferedLogger, OutputParser, \
+    get_log_context, log_context
 import scriptharness.process
 import scriptharness.status
 from scriptharness.unicode import to_unicode
+from six.moves.queue import Empty, Queue
 import subprocess
 import tempfile
+import threading
 
 
 # Constants {{{1
 LOGGER_NAME = "scriptharness.commands"
+COMMAND_IDS = itertools.count(1)
+OUTPUT_CHUNK_SIZE = 65536
+SPOOL_SIZE = 1024 * 1024
 STRINGS = {
     "check_output": {
         "pre_msg":
@@ -47,6 +60,7 @@ STRINGS = {
         "error": "Command %(command)s failed.",
         "env": "Using env: %(env)s",
         "kill_hung_process": "Killing process that's still here",
+        "cgroup": "Can't create a cgroup in %(cgroup)s: %(error)s",
     },
     "output": {
         "cwd_doesn't_exist":
@@ -65,6 +79,7 @@ STRINGS = {
         "env": "Using env: %(env)s",
         "kill_hung_process": "Killing process that's still here",
         "temp_files": "Temporary files: stdout %(stdout)s; stderr %(stderr)s",
+        "cgroup": "Can't create a cgroup in %(cgroup)s: %(error)s",
     },
 }
 
@@ -130,6 +145,23 @@ def detect_parsed_errors(command):
     return status
 
 
+def detect_parsed_output_errors(command):
+    """Very basic detect_errors_cb for ParsedOutput.
+
+    This looks in the history of each of command.parsers for num_errors.
+    If these are all 0, the command is successful.  Otherwise it's
+    unsuccessful.
+
+    Args:
+      command (ParsedOutput): instance of `ParsedOutput` class
+    """
+    status = scriptharness.status.SUCCESS
+    for parser in command.parsers.values():
+        if parser.history.get('num_errors'):
+            status = scriptharness.status.ERROR
+    return status
+
+
 # Command {{{1
 class Command(object):
     """Basic command: run and log output.  Stdout and stderr are interleaved
@@ -152,12 +184,23 @@ class Command(object):
         for the optional 'output_timeout' and 'timeout', which are processed by
         Command.  `output_timeout` is how long a command can run without
         outputting anything to the screen/log.  `timeout` is how long the
-        command can run, total.
+        command can run, total.  The optional 'encoding' and 'errors' are
+        used to decode the output; see get_splitter().  The optional
+        'cgroup' is the path of a delegated cgroup-v2 parent to run the
+        command in a child cgroup of; see prepare_run().
 
       strings (Dict[str, str]): Strings to log.
+
+      command_id (int): a unique id for this command.  While the command
+        runs, this is in the log context, so structured logs can tell which
+        command each line came from.
+
+      cgroup (str): the path of the cgroup the command runs in, or None.
     """
     def __init__(self, command, logger=None, detect_error_cb=None, **kwargs):
         self.command = command
+        self.command_id = next(COMMAND_IDS)
+        self.cgroup = None
         self.logger = logger or logging.getLogger(LOGGER_NAME)
         self.detect_error_cb = detect_error_cb or detect_errors
         self.history = {}
@@ -236,9 +279,80 @@ class Command(object):
         """
         self.logger.info(" %s", to_unicode(line.rstrip()))
 
+    def add_lines(self, lines):
+        """Process a batch of output lines.  By default this sends each line
+        to add_line(); subclasses can override this to handle the whole
+        batch at once.
+
+        Args:
+          lines (List[str]): lines of output
+        """
+        for line in lines:
+            self.add_line(line)
+
+    def prepare_run(self):
+        """Fix the env, log the start of the command, and pop the timeouts
+        out of self.kwargs so the rest can go to subprocess.Popen.
+
+        On posix, the command is started in its own session, so on timeout
+        the whole process group can be killed at once; pass
+        start_new_session=False to keep it in ours.  If the 'cgroup' kwarg
+        is set, the command also runs in its own cgroup under that path, so
+        even children that start a new session are killed.  If we can't
+        create the cgroup, we warn and run without it.
+
+        Returns:
+          Tuple[int, int]: (output_timeout, max_timeout); either may be None.
+        """
+        if 'env' in self.kwargs:
+            self.kwargs['env'] = self.fix_env(self.kwargs['env'])
+        self.log_start()
+        output_timeout = self.kwargs.pop('output_timeout', None)
+        max_timeout = self.kwargs.pop('timeout', None)
+        cgroup_parent = self.kwargs.pop('cgroup', None)
+        if cgroup_parent:
+            try:
+                self.cgroup = scriptharness.process.create_cgroup(
+                    cgroup_parent, "%d-%d" % (os.getpid(), self.command_id)
+                )
+            except OSError as exc_info:
+                self.logger.warning(self.strings['cgroup'], {
+                    'cgroup': cgroup_parent, 'error': exc_info,
+                })
+        popen_kwargs = scriptharness.process.get_popen_kwargs(self.cgroup)
+        for key, value in popen_kwargs.items():
+            self.kwargs.setdefault(key, value)
+        if isinstance(self.command, (list, tuple)):
+            self.kwargs.setdefault('shell', False)
+        else:
+            self.kwargs.setdefault('shell', True)
+        return output_timeout, max_timeout
+
+    def get_splitter(self):
+        """Pop the 'encoding' and 'errors' kwargs out of self.kwargs, and
+        return a LineSplitter that decodes the output with them.
+
+        The output is decoded a chunk at a time with an incremental decoder,
+        so add_line() and add_lines() get unicode lines.  'encoding'
+        defaults to 'utf-8'; set it to None to get the lines as bytes.
+        'errors' defaults to 'strict'; 'replace' will log undecodable output
+        rather than raising UnicodeDecodeError.
+
+        Returns:
+          scriptharness.process.LineSplitter: the splitter to use.
+        """
+        return scriptharness.process.LineSplitter(
+            encoding=self.kwargs.pop('encoding', 'utf-8'),
+            errors=self.kwargs.pop('errors', 'strict')
+        )
+
     def finish_process(self):
-        """Here for subclassing.
+        """Kill anything left in our cgroup, if we have one, and raise on
+        error.  Here for subclassing.
         """
+        if self.cgroup is not None:
+            scriptharness.process.kill_cgroup(self.cgroup)
+            self.cgroup = None
         if self.history['status'] != scriptharness.status.SUCCESS:
             raise ScriptHarnessError(
                 self.strings["error"] % {'command': self.command, }
@@ -250,33 +364,26 @@ class Command(object):
         Raises:
           scriptharness.exceptions.ScriptHarnessError on error
         """
-        if 'env' in self.kwargs:
-            self.kwargs['env'] = self.fix_env(self.kwargs['env'])
-        self.log_start()
-        output_timeout = self.kwargs.get('output_timeout', None)
-        if 'output_timeout' in self.kwargs:
-            del self.kwargs['output_timeout']
-        max_timeout = self.kwargs.get('timeout', None)
-        if 'timeout' in self.kwargs:
-            del self.kwargs['timeout']
-        if isinstance(self.command, (list, tuple)):
-            self.kwargs.setdefault('shell', False)
-        else:
-            self.kwargs.setdefault('shell', True)
-        queue = multiprocessing.Queue()  # pylint: disable=no-member
-        runner = multiprocessing.Process(  # pylint: disable=not-callable
-            target=scriptharness.process.command_subprocess,
-            args=(queue, self.command),
-            kwargs=self.kwargs,
-        )
-        runner.start()
-        self.history['return_value'] = scriptharness.process.watch_command(
-            self.logger, queue, runner, self.add_line,
-            output_timeout=output_timeout, max_timeout=max_timeout
-        )
-        self.history['status'] = self.detect_error_cb(self)
-        self.finish_process()
-        return self.history['status']
+        with log_context(command_id=self.command_id):
+            output_timeout, max_timeout = self.prepare_run()
+            splitter = self.get_splitter()
+            self.kwargs['stdout'] = subprocess.PIPE
+            self.kwargs['stderr'] = subprocess.STDOUT
+            self.kwargs['bufsize'] = 0
+            try:
+                process = subprocess.Popen(self.command, **self.kwargs)
+            except OSError as exc_info:
+                raise ScriptHarnessError(
+                    "Can't run command!", self.command, exc_info
+                )
+            self.history['return_value'] = scriptharness.process.watch_pipe(
+                self.logger, process, self.add_line,
+                output_timeout=output_timeout, max_timeout=max_timeout,
+                add_lines_cb=self.add_lines, splitter=splitter
+            )
+            self.history['status'] = self.detect_error_cb(self)
+            self.finish_process()
+            return self.history['status']
 
 
 # ParsedCommand {{{1
@@ -309,29 +416,124 @@ class ParsedCommand(Command):
         self.parser.add_line(line)
 
 
+# SpooledOutputFile {{{1
+class SpooledOutputFile(object):
+    """Keep output in memory until it grows past max_size, then spill it
+    to a NamedTemporaryFile.  Unlike tempfile.SpooledTemporaryFile, the
+    spilled file has a name, and the output is still available after
+    close().
+
+    Attributes:
+      max_size (int): the most bytes to keep in memory.
+
+      buffer (io.BytesIO): the in-memory output, until we spill.  None
+        afterwards.
+
+      file (NamedTemporaryFile): the temp file, once we spill.  None before.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = io.BytesIO()
+        self.file = None
+
+    def __repr__(self):
+        if self.file is None:
+            return "<SpooledOutputFile in memory>"
+        return "<SpooledOutputFile %s>" % self.name
+
+    @property
+    def name(self):
+        """The path to the temp file, or None if we haven't spilled.
+        """
+        if self.file is None:
+            return None
+        return self.file.name
+
+    def spill(self):
+        """Move the in-memory output to a NamedTemporaryFile.
+        """
+        if self.file is not None:
+            return
+        keywargs = {'delete': False}
+        if six.PY2:
+            keywargs['bufsize'] = 0
+        else:
+            keywargs['buffering'] = 0
+        self.file = tempfile.NamedTemporaryFile(**keywargs)
+        self.file.write(self.buffer.getvalue())
+        self.buffer = None
+
+    def write(self, data):
+        """Write data, spilling to a temp file if it would go over max_size.
+
+        Args:
+          data (bytes): the data to write.
+        """
+        if self.file is None and \
+                self.buffer.tell() + len(data) > self.max_size:
+            self.spill()
+        if self.file is None:
+            self.buffer.write(data)
+        else:
+            self.file.write(data)
+
+    def getvalue(self):
+        """Get the in-memory output.
+
+        Returns:
+          bytes: the output.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessException: if we've spilled
+            to a file.
+        """
+        if self.file is not None:
+            raise ScriptHarnessException(
+                "Output spilled to %s; read the file instead." % self.name
+            )
+        return self.buffer.getvalue()
+
+    def close(self):
+        """Close the temp file, if any.  In-memory output stays readable.
+        """
+        if self.file is not None:
+            self.file.close()
+
+
 # Output {{{1
 class Output(Command):
     """Run the command and capture stdout and stderr to separate files.
     The output can be binary or text.
 
+    If the optional spool_size kwarg is set, stdout and stderr are kept in
+    memory, and each only goes to a temp file if it grows past spool_size
+    bytes.
+
     Attributes:
       strings (Dict[str, str]): Strings to log.
-      stdout (NamedTemporaryFile): file to log stdout to
+      stdout (NamedTemporaryFile or SpooledOutputFile): file to log
+        stdout to
 
-      stderr (NamedTemporaryFile): file to log stderr to
+      stderr (NamedTemporaryFile or SpooledOutputFile): file to log
+        stderr to
 
       + all of the attributes in scriptharness.commands.Command
     """
     def __init__(self, *args, **kwargs):
         super(Output, self).__init__(*args, **kwargs)
         self.strings = deepcopy(STRINGS['output'])
-        keywargs = {'delete': False}
-        if six.PY2:
-            keywargs['bufsize'] = 0
+        spool_size = self.kwargs.pop('spool_size', None)
+        if spool_size:
+            self.stdout = SpooledOutputFile(spool_size)
+            self.stderr = SpooledOutputFile(spool_size)
         else:
-            keywargs['buffering'] = 0
-        self.stdout = tempfile.NamedTemporaryFile(**keywargs)
-        self.stderr = tempfile.NamedTemporaryFile(**keywargs)
+            keywargs = {'delete': False}
+            if six.PY2:
+                keywargs['bufsize'] = 0
+            else:
+                keywargs['buffering'] = 0
+            self.stdout = tempfile.NamedTemporaryFile(**keywargs)
+            self.stderr = tempfile.NamedTemporaryFile(**keywargs)
         self.logger.debug(
             self.strings['temp_files'], {
                 'stdout': self.stdout,
@@ -348,69 +550,280 @@ class Output(Command):
 
     def run(self):
         """Output.run()
+
+        stdout and stderr are read through pipes and written to the temp
+        files as the output arrives, so we know exactly when the command
+        last produced output, and when it exits.
         """
-        if 'env' in self.kwargs:
-            self.kwargs['env'] = self.fix_env(self.kwargs['env'])
-        self.log_start()
-        output_timeout = self.kwargs.get('output_timeout', None)
-        if 'output_timeout' in self.kwargs:
-            del self.kwargs['output_timeout']
-        max_timeout = self.kwargs.get('timeout', None)
-        if 'timeout' in self.kwargs:
-            del self.kwargs['timeout']
-        if isinstance(self.command, (list, tuple)):
-            self.kwargs.setdefault('shell', False)
-        else:
-            self.kwargs.setdefault('shell', True)
-        self.kwargs['stdout'] = self.stdout.file
-        self.kwargs['stderr'] = self.stderr.file
-        try:
-            process = subprocess.Popen(self.command, **self.kwargs)
-        except OSError as exc_info:
-            raise ScriptHarnessError(
-                "Can't run command!", self.command, exc_info
+        with log_context(command_id=self.command_id):
+            output_timeout, max_timeout = self.prepare_run()
+            self.kwargs['stdout'] = subprocess.PIPE
+            self.kwargs['stderr'] = subprocess.PIPE
+            self.kwargs['bufsize'] = 0
+            try:
+                process = subprocess.Popen(self.command, **self.kwargs)
+            except OSError as exc_info:
+                raise ScriptHarnessError(
+                    "Can't run command!", self.command, exc_info
+                )
+            self.history['return_value'] = scriptharness.process.watch_pipes(
+                self.logger, process, {
+                    process.stdout: self.stdout.write,
+                    process.stderr: self.stderr.write,
+                }, output_timeout=output_timeout, max_timeout=max_timeout
             )
-        self.history['return_value'] = scriptharness.process.watch_output(
-            self.logger, process, self.stdout, self.stderr,
-            output_timeout=output_timeout, max_timeout=max_timeout
-        )
-        self.history['status'] = self.detect_error_cb(self)
-        self.finish_process()
-        return self.history['status']
+            self.history['status'] = self.detect_error_cb(self)
+            self.finish_process()
+            return self.history['status']
+
+    def get_output_path(self, handle_name="stdout"):
+        """Get the path to the stdout or stderr temp file.
+
+        Args:
+          handle_name (Optional["stdout" or "stderr"]): the handle to get
+            the path of.  Defaults to "stdout"
+
+        Returns:
+          str: the path to the temp file, or None if the output is
+            in memory.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessException: on a bad
+            handle_name.
+        """
+        if handle_name not in ("stdout", "stderr"):
+            raise ScriptHarnessException("Bad handle for get_output: %s" %
+                                         handle_name)
+        return getattr(self, handle_name).name
+
+    @contextmanager
+    def open_output(self, handle_name="stdout"):
+        """Open the output for binary reading, from memory or the temp file.
+
+        Args:
+          handle_name (Optional["stdout" or "stderr"]): the handle to read
+            from.  Defaults to "stdout"
+
+        Yields:
+          file: a binary filehandle at the start of the output.
+        """
+        path = self.get_output_path(handle_name)
+        if path is None:
+            yield io.BytesIO(getattr(self, handle_name).getvalue())
+        else:
+            with open(path, 'rb') as filehandle:
+                yield filehandle
 
     def get_output(self, handle_name="stdout", text=True):
         """Get output from file.  This reads the output into memory, so
-        this is not appropriate for large amounts of output.
+        this is not appropriate for large amounts of output; use
+        iter_lines(), iter_chunks() or mmap_output() for those.
 
         Args:
           handle_name (Optional["stdout" or "stderr"]): the handle to read
             from.  Defaults to "stdout"
 
           text (Optional[bool]): whether the output is text.  If so, run
-            output through to_unicode() and rstrip().  Defaults to True.
+            output through to_unicode() and rstrip().  Otherwise return
+            the raw bytes.  Defaults to True.
         """
-        if handle_name not in ("stdout", "stderr"):
-            raise ScriptHarnessException("Bad handle for get_output: %s" %
-                                         handle_name)
-        handle = getattr(self, handle_name)
-        with open(handle.name) as filehandle:
+        with self.open_output(handle_name) as filehandle:
             contents = filehandle.read()
         if text:
             contents = to_unicode(contents).rstrip()
         return contents
 
+    def iter_lines(self, handle_name="stdout", text=True):
+        """Iterate over the lines of output, one line in memory at a time.
+
+        Args:
+          handle_name (Optional["stdout" or "stderr"]): the handle to read
+            from.  Defaults to "stdout"
+
+          text (Optional[bool]): whether the output is text.  If so, run
+            each line through to_unicode() and strip the line ending.
+            Otherwise yield the raw bytes, line ending included.
+            Defaults to True.
+
+        Yields:
+          str or bytes: each line of output.
+        """
+        with self.open_output(handle_name) as filehandle:
+            for line in filehandle:
+                if text:
+                    line = to_unicode(line.rstrip(b"\r\n"))
+                yield line
+
+    def iter_chunks(self, handle_name="stdout",
+                    chunk_size=OUTPUT_CHUNK_SIZE):
+        """Iterate over the output in fixed size byte chunks.  This is
+        binary safe.
+
+        Args:
+          handle_name (Optional["stdout" or "stderr"]): the handle to read
+            from.  Defaults to "stdout"
+
+          chunk_size (Optional[int]): the maximum size of each chunk, in
+            bytes.  Defaults to OUTPUT_CHUNK_SIZE.
+
+        Yields:
+          bytes: the next chunk of output.  Only the last chunk may be
+            shorter than chunk_size.
+        """
+        with self.open_output(handle_name) as filehandle:
+            while True:
+                chunk = filehandle.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    @contextmanager
+    def mmap_output(self, handle_name="stdout"):
+        """Map the output into memory, read-only.  The operating system
+        pages the file in as it's accessed, so this allows for slicing,
+        find() and re searches on large output without reading it all.
+
+        Empty files can't be mapped, so an empty bytes object is yielded
+        for those.  In-memory output is yielded as bytes.
+
+        Args:
+          handle_name (Optional["stdout" or "stderr"]): the handle to map.
+            Defaults to "stdout"
+
+        Yields:
+          mmap.mmap or bytes: the read-only view of the output.
+        """
+        path = self.get_output_path(handle_name)
+        if path is None:
+            yield getattr(self, handle_name).getvalue()
+            return
+        with open(path, 'rb') as filehandle:
+            if not os.fstat(filehandle.fileno()).st_size:
+                yield b""
+                return
+            view = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield view
+            finally:
+                view.close()
+
     def cleanup(self):
         """Best effort cleanup of stdout and stderr temp files.
         """
         for handle in self.stdout, self.stderr:
             try:
                 handle.close()
-                os.remove(handle.name)
+                if handle.name is not None:
+                    os.remove(handle.name)
             except Exception:  # pylint: disable=broad-except
                 # Broad exception especially for windows nosetests
                 pass
 
 
+# ParsedOutput {{{1
+class ParsedOutput(Output):
+    """Capture stdout and stderr to separate files, like Output, and parse
+    each of them with its own OutputParser, like ParsedCommand.
+
+    Each chunk of output is read from its pipe once, written to the file
+    unchanged, and then split into lines for the parser.  The files are
+    binary-safe artifacts, and the error scan happens during the same run.
+
+    Attributes:
+      parsers (Dict[str, OutputParser]): the "stdout" and "stderr" parsers.
+
+      + all of the attributes in scriptharness.commands.Output
+    """
+    def __init__(self, command, error_list=None, stdout_parser=None,
+                 stderr_parser=None, **kwargs):
+        """Initialization method for ParsedOutput.
+
+        Args:
+          command (List[str] or str): the command to run.
+
+          error_list (Optional[ErrorList]): the ErrorList to build any
+            missing parsers with.  Required unless both parsers are given.
+
+          stdout_parser (Optional[OutputParser]): the parser for stdout.
+
+          stderr_parser (Optional[OutputParser]): the parser for stderr.
+
+          **kwargs: kwargs for Output.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessException: if a parser is
+            missing and error_list isn't an ErrorList.
+        """
+        self.parsers = {'stdout': stdout_parser, 'stderr': stderr_parser}
+        for handle_name, parser in self.parsers.items():
+            if parser is None:
+                if not isinstance(error_list, ErrorList):
+                    raise ScriptHarnessException(
+                        "error_list must be an ErrorList!",
+                        error_list
+                    )
+                self.parsers[handle_name] = OutputParser(error_list)
+        kwargs.setdefault("detect_error_cb", detect_parsed_output_errors)
+        super(ParsedOutput, self).__init__(command, **kwargs)
+
+    def get_tee_cb(self, handle_name, splitter):
+        """Get a watch_pipes() callback that writes each chunk to the
+        handle_name file and sends its lines to the handle_name parser.
+
+        Args:
+          handle_name ("stdout" or "stderr"): the stream to tee.
+
+          splitter (LineSplitter): the splitter for this stream.
+
+        Returns:
+          Callable[[bytes]]: the callback.
+        """
+        write = getattr(self, handle_name).write
+        add_line = self.parsers[handle_name].add_line
+
+        def tee_cb(chunk):
+            """Write the chunk, then parse its lines."""
+            write(chunk)
+            for line in splitter.split(chunk):
+                add_line(line)
+        return tee_cb
+
+    def run(self):
+        """Run the command, teeing stdout and stderr to their files and
+        parsers.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessError on error
+        """
+        with log_context(command_id=self.command_id):
+            output_timeout, max_timeout = self.prepare_run()
+            splitters = {'stdout': self.get_splitter()}
+            splitters['stderr'] = splitters['stdout'].copy()
+            self.kwargs['stdout'] = subprocess.PIPE
+            self.kwargs['stderr'] = subprocess.PIPE
+            self.kwargs['bufsize'] = 0
+            try:
+                process = subprocess.Popen(self.command, **self.kwargs)
+            except OSError as exc_info:
+                raise ScriptHarnessError(
+                    "Can't run command!", self.command, exc_info
+                )
+            self.history['return_value'] = scriptharness.process.watch_pipes(
+                self.logger, process, {
+                    process.stdout: self.get_tee_cb('stdout',
+                                                    splitters['stdout']),
+                    process.stderr: self.get_tee_cb('stderr',
+                                                    splitters['stderr']),
+                }, output_timeout=output_timeout, max_timeout=max_timeout
+            )
+            for handle_name, splitter in splitters.items():
+                for line in splitter.flush():
+                    self.parsers[handle_name].add_line(line)
+            self.history['status'] = self.detect_error_cb(self)
+            self.finish_process()
+            return self.history['status']
+
+
 # run {{{1
 def run(command, cmd_class=Command, halt_on_failure=False, *args, **kwargs):
     """Shortcut for running a Command.
@@ -453,6 +866,136 @@ def run(command, cmd_class=Command, halt_on_failure=False, *args, **kwargs):
         return cmd
 
 
+# run_parallel {{{1
+@contextmanager
+def buffered_logs(cmd, lock):
+    """Buffer everything cmd logs, and log it all at once at the end.
+
+    This replaces the loggers of cmd, and its parsers and their context
+    buffers if it has them, with BufferedLoggers that share a single list
+    of records.
+
+    Args:
+      cmd (Command): the command to buffer the logs of.
+
+      lock (threading.Lock): held while flushing the buffered records, so
+        the output of different commands doesn't interleave.
+    """
+    targets = [cmd]
+    parsers = list(getattr(cmd, 'parsers', {}).values())
+    if getattr(cmd, 'parser', None) is not None:
+        parsers.append(cmd.parser)
+    for parser in parsers:
+        targets.append(parser)
+        if parser.context_buffer is not None:
+            targets.append(parser.context_buffer)
+    originals = [(target, target.logger) for target in targets]
+    records = []
+    for target, logger in originals:
+        target.logger = BufferedLogger(logger, records=records)
+    try:
+        yield
+    finally:
+        for target, logger in originals:
+            target.logger = logger
+        with lock:
+            BufferedLogger(None, records=records).flush()
+
+
+def run_parallel(command_list, workers=None, cmd_class=Command,
+                 halt_on_failure=False, **kwargs):
+    """Run a number of commands in parallel, across a pool of worker threads.
+
+    Each command's log lines are buffered and logged together when the
+    command finishes, so the output stays readable.
+
+    Args:
+      command_list (List[List[str] or str or Command]): the commands to run.
+        These can be command lines, which will be used to create cmd_class
+        objects, or Command objects (including subclasses).
+
+      workers (Optional[int]): the max number of commands to run at once.
+        Defaults to the number of cpus.
+
+      cmd_class (Optional[Command subclass]): the class to instantiate for
+        command lines.  Defaults to scriptharness.commands.Command.
+
+      halt_on_failure (Optional[bool]): if True, don't start any more
+        commands after a failure, and raise ScriptHarnessFatal once the
+        running commands finish.  Default: False
+
+      **kwargs: kwargs for cmd_class, for command lines.
+
+    Returns:
+      Tuple[int, List[Command]]: the worst status of the commands, and the
+        command objects in the same order as command_list.  Commands that
+        never ran (because of halt_on_failure or a ScriptHarnessFatal) have
+        no 'status' in their history.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: on fatal error
+    """
+    cmds = []
+    jobs = Queue()
+    for command in command_list:
+        if not isinstance(command, Command):
+            command = cmd_class(command, **kwargs)
+        cmds.append(command)
+        jobs.put(command)
+    halt = threading.Event()
+    lock = threading.Lock()
+    messages = []
+    fatals = []
+    parent_context = get_log_context()
+
+    def worker():
+        """Run commands until there are none left, or we halt."""
+        while not halt.is_set():
+            try:
+                cmd = jobs.get(block=False)
+            except Empty:
+                return
+            message = None
+            with log_context(**parent_context), buffered_logs(cmd, lock):
+                try:
+                    cmd.run()
+                except ScriptHarnessError as exc_info:
+                    message = "error: %s" % exc_info
+                    cmd.history.setdefault('status',
+                                           scriptharness.status.ERROR)
+                except ScriptHarnessTimeout as exc_info:
+                    message = "timeout: %s" % exc_info
+                    cmd.history.setdefault('status',
+                                           scriptharness.status.TIMEOUT)
+                except ScriptHarnessFatal as exc_info:
+                    cmd.history.setdefault('status',
+                                           scriptharness.status.FATAL)
+                    fatals.append(exc_info)
+                    halt.set()
+            if message:
+                messages.append(message)
+                if halt_on_failure:
+                    halt.set()
+
+    threads = []
+    for _ in range(min(workers or multiprocessing.cpu_count(), len(cmds))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if fatals:
+        raise fatals[0]
+    if halt_on_failure and messages:
+        raise ScriptHarnessFatal("Fatal %s" % messages[0])
+    status = scriptharness.status.SUCCESS
+    for cmd in cmds:
+        status = max(status, cmd.history.get('status',
+                                             scriptharness.status.SUCCESS))
+    return status, cmds
+
+
 # parse {{{1
 def parse(command, **kwargs):
     """Shortcut for running a ParsedCommand.
@@ -534,15 +1077,17 @@ def get_text_output(command, level=logging.INFO, **kwargs):
 
       level (int): logging level
 
-      **kwargs: kwargs to send to scriptharness.commands.Output
+      **kwargs: kwargs to send to scriptharness.commands.Output.
+        spool_size defaults to SPOOL_SIZE, so short output never touches
+        the disk.
 
     Returns:
       output (str): the stdout from the command.
     """
-    cmd = Output(command, **kwargs)
+    kwargs.setdefault('spool_size', SPOOL_SIZE)
     with get_output(command, **kwargs) as cmd:
         output = cmd.get_output()
         cmd.logger.log(level, "Got output:")
-        for line in output.splitlines():
+        for line in cmd.iter_lines():
             cmd.logger.log(level, " {}".format(line.rstrip()))
     return output
@@ -57,6 +57,12 @@ DEFAULT_CONFIG_DEFINITION = {
         "default": "%(scriptharness_base_dir)s{}artifacts".format(os.sep),
         "help": "The directory to copy artifacts to."
     },
+    "scriptharness_config_backups": {
+        "default": 5,
+        "type": int,
+        "help": "The number of previous localconfig.json dumps to keep in "
+                "scriptharness_artifact_dir.",
+    },
     "config_files": {
         "options": ['--config-file', '--cfg', '-c'],
         "action": 'append',
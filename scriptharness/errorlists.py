@@ -14,6 +14,10 @@ import re
 from scriptharness.exceptions import ScriptHarnessException, \
     ScriptHarnessFatal
 import six
+try:
+    from re import _parser as sre_parse  # py3.11+
+except ImportError:
+    import sre_parse
 
 
 # ErrorList helper methods {{{1
@@ -113,6 +117,38 @@ def check_context_lines(context_lines, orig_context_lines, name, messages):
     return max(context_lines, orig_context_lines)
 
 
+def get_required_literal(regex):
+    """Find the longest literal string that every match of regex must
+    contain, so we can skip the regex search for lines that don't contain
+    it.
+
+    Only literals at the top level of the regex are considered; anything
+    inside a group, branch, or repeat breaks up the literal.
+
+    Args:
+      regex (regex): a compiled regex.
+
+    Returns:
+      str: the required literal, or None if there isn't one we can use.
+    """
+    if regex.flags & re.IGNORECASE or \
+            not isinstance(regex.pattern, six.text_type):
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    longest = current = ''
+    for opcode, value in parsed:
+        if opcode == sre_parse.LITERAL:
+            current += six.unichr(value)
+            if len(current) > len(longest):
+                longest = current
+        else:
+            current = ''
+    return longest or None
+
+
 # ErrorList {{{1
 class ErrorList(list):
     """Error lists, to describe how to parse output.  In object form for
@@ -156,12 +192,75 @@ class ErrorList(list):
         in pre_context_lines.
       post_context_lines (int): The max number of lines the error_list defines
         in post_context_lines.
+      substrs (Tuple[str, ...]): all of the substr error_checks, for match().
+      searches (Tuple[Tuple[str, Callable[[str], Any]], ...]): (literal,
+        search) for all of the regex error_checks, for match().  literal is
+        the string the regex requires (see get_required_literal()), or None.
+      matchers (Tuple[Tuple[str, Callable[[str], Any], Dict], ...]):
+        (literal, search, error_check) for each error_check, in order.  For
+        substr error_checks, literal is the substr and search is None.
     """
     def __init__(self, error_list, strict=True):
         self.strict = strict
         (self.pre_context_lines, self.post_context_lines) = \
             self.validate_error_list(error_list)
         super(ErrorList, self).__init__(error_list)
+        (self.substrs, self.searches, self.matchers) = \
+            self.compile_error_list()
+
+    def compile_error_list(self):
+        """Flatten the error_checks into tuples, so match() doesn't have to
+        look up the dict keys of each error_check for each line.
+
+        Returns:
+          Tuple[tuple, tuple, tuple]: (substrs, searches, matchers)
+        """
+        substrs = []
+        searches = []
+        matchers = []
+        for error_check in self:
+            if 'substr' in error_check:
+                substrs.append(error_check['substr'])
+                matchers.append((error_check['substr'], None, error_check))
+            else:
+                literal = get_required_literal(error_check['regex'])
+                searches.append((literal, error_check['regex'].search))
+                matchers.append(
+                    (literal, error_check['regex'].search, error_check)
+                )
+        return (tuple(substrs), tuple(searches), tuple(matchers))
+
+    def match(self, line):
+        """Find the first error_check that matches line.
+
+        Most lines don't match anything, so we first check all the substrs
+        and then all the regexes, in whatever order is fastest; a line that
+        matches nothing is rejected there.  Regexes are only searched if the
+        line contains their required literal.  Only lines that match
+        something are walked through the error_checks in order, to keep the
+        first-match-wins ordering.
+
+        Args:
+          line (str): the line of output to check.
+
+        Returns:
+          Dict[str, str or regex]: the first matching error_check, or None.
+        """
+        for substr in self.substrs:
+            if substr in line:
+                break
+        else:
+            for literal, search in self.searches:
+                if (literal is None or literal in line) and search(line):
+                    break
+            else:
+                return None
+        for literal, search, error_check in self.matchers:
+            if literal is not None and literal not in line:
+                continue
+            if search is None or search(line):
+                return error_check
+        return None
 
     def validate_error_list(self, error_list):
         """Validate an error_list.
@@ -8,23 +8,75 @@ Attributes:
   DEFAULT_DATEFMT (str): default logging date format
   DEFAULT_FMT (str): default logging format
   DEFAULT_LEVEL (int): default logging level
+  DEFAULT_QUEUE_SIZE (int): default max number of records QueueHandler
+    will queue
+  DEFAULT_BUFFER_SIZE (int): default number of characters
+    BufferedFileHandler collects before writing
+  DEFAULT_FLUSH_INTERVAL (float): default max number of seconds between
+    BufferedFileHandler writes
+  COMPRESSION_GZIP (str): CompressedFileHandler gzip compression
+  COMPRESSION_LZMA (str): CompressedFileHandler lzma (xz) compression;
+    python 3.3+ only
+  DEFAULT_COMPRESS_LEVEL (int): default gzip compresslevel or lzma preset
+  GZIP_MAGIC (bytes): the start of a gzip file, for open_log()
+  LZMA_MAGIC (bytes): the start of an xz file, for open_log()
+  OVERFLOW_BLOCK (str): QueueHandler overflow policy: wait for room in the
+    queue
+  OVERFLOW_DROP (str): QueueHandler overflow policy: drop records below
+    logging.WARNING when the queue is full
+  END_OF_QUEUE (None): QueueHandler.close() puts this in the queue to stop
+    the background thread
+  JSON_CONTEXT_KEYS (Tuple[str, ...]): the log context keys JsonFormatter
+    adds to each line, when set
+  monotonic (Callable[[], float]): time.monotonic(), or time.time() in py2
 """
 
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
-from copy import deepcopy
+from collections import deque
+from contextlib import contextmanager
+from copy import copy, deepcopy
+import gzip
+import io
+from itertools import islice
+import json
 import logging
+import logging.handlers
 import os
 from scriptharness.exceptions import ScriptHarnessException
-from scriptharness.os import make_parent_dir
+from scriptharness.os import make_parent_dir, rotate_file
 from scriptharness.unicode import to_unicode
 import six
+from six.moves.queue import Full, Queue
+import threading
 import time
+try:
+    import contextvars
+except ImportError:  # py<3.7
+    contextvars = None
+try:
+    import lzma
+except ImportError:  # py2
+    lzma = None
 
 LOGGER_NAME = "scriptharness.log"
 DEFAULT_DATEFMT = '%H:%M:%S'
 DEFAULT_FMT = '%(asctime)s %(levelname)8s - %(message)s'
 DEFAULT_LEVEL = logging.INFO
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BUFFER_SIZE = 65536
+DEFAULT_FLUSH_INTERVAL = 5.
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_LZMA = 'lzma'
+DEFAULT_COMPRESS_LEVEL = 6
+GZIP_MAGIC = b'\x1f\x8b'
+LZMA_MAGIC = b'\xfd7zXZ\x00'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP = 'drop'
+END_OF_QUEUE = None
+JSON_CONTEXT_KEYS = ('action', 'command_id')
+# pylint: disable=invalid-name
+monotonic = getattr(time, 'monotonic', time.time)
 
 
 # UnicodeFormatter {{{1
@@ -42,24 +94,207 @@ class UnicodeFormatter(logging.Formatter):
             string = string.encode(self.encoding, 'replace')
         return string
 
+class CachedFormatter(UnicodeFormatter):
+    """A UnicodeFormatter that does less work per record.  Whether the
+    format uses the time is checked once, rather than for every record,
+    and the formatted time is cached per second, since strftime() can only
+    change once a second.  Sharing one CachedFormatter between handlers
+    means each timestamp is formatted once for all of them.
+
+    This only supports %-style formats with a datefmt; without a datefmt,
+    logging adds milliseconds to the time, so it isn't cached.
+
+    Attributes:
+      uses_time (bool): whether the format uses %(asctime)s.
+      cached_time (Tuple[int, str]): the second and the formatted time for
+        the last record.  This is a single tuple so threads can't see a
+        mismatched second and time.
+    """
+    def __init__(self, fmt=None, datefmt=None):
+        super(CachedFormatter, self).__init__(fmt=fmt, datefmt=datefmt)
+        self.uses_time = self.usesTime()
+        self.cached_time = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        """Return the cached formatted time if the record is from the same
+        second as the previous one.
+
+        Args:
+          record (logging.LogRecord): the record to format the time for.
+          datefmt (Optional[str]): the time.strftime() format.
+
+        Returns:
+          str: the formatted time.
+        """
+        if not datefmt:
+            return super(CachedFormatter, self).formatTime(record, datefmt)
+        second = int(record.created)
+        cached_second, string = self.cached_time
+        if second != cached_second:
+            string = time.strftime(datefmt, self.converter(record.created))
+            self.cached_time = (second, string)
+        return string
+
+    def format(self, record):
+        record.message = record.getMessage()
+        if self.uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+        string = self._fmt % record.__dict__
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if string[-1:] != "\n":
+                string += "\n"
+            string += record.exc_text
+        if getattr(record, 'stack_info', None):
+            if string[-1:] != "\n":
+                string += "\n"
+            string += self.formatStack(record.stack_info)
+        if six.PY2 and isinstance(string, six.text_type):
+            string = string.encode(self.encoding, 'replace')
+        return string
+
+
+
+# Log context {{{1
+if contextvars is not None:
+    _LOG_CONTEXT = contextvars.ContextVar('scriptharness_log_context',
+                                          default={})
+else:
+    _LOG_CONTEXT = threading.local()
+
+
+def get_log_context():
+    """Get the current log context: the action name, command id, etc. that
+    structured logs attach to each record.  This is per-thread, and per
+    asyncio task in python 3.7+.
+
+    Returns:
+      Dict[str, Any]: the log context.  Don't modify this; use
+        log_context() instead.
+    """
+    if contextvars is not None:
+        return _LOG_CONTEXT.get()
+    return getattr(_LOG_CONTEXT, 'values', {})
+
+
+def _set_log_context(values):
+    """Replace the current log context.
+
+    Args:
+      values (Dict[str, Any]): the new log context.
+    """
+    if contextvars is not None:
+        _LOG_CONTEXT.set(values)
+    else:
+        _LOG_CONTEXT.values = values
+
+
+@contextmanager
+def log_context(**kwargs):
+    """Add kwargs to the log context until the with block exits::
+
+      with log_context(action="build"):
+          ...
+
+    The context only changes when entering and exiting the block, so
+    records don't have to work out their action or command themselves.
+
+    Args:
+      **kwargs: the values to add to the log context.
+    """
+    previous = get_log_context()
+    _set_log_context(dict(previous, **kwargs))
+    try:
+        yield
+    finally:
+        _set_log_context(previous)
+
+
+def add_log_context(record):
+    """Add the log context and a monotonic timestamp to record, if they
+    haven't been added already.  Values already on the record, e.g. from
+    `extra`, win.
+
+    Args:
+      record (logging.LogRecord): the record to add the context to.
+
+    Returns:
+      logging.LogRecord: the record.
+    """
+    if not hasattr(record, 'monotonic'):
+        record.monotonic = monotonic()
+        for key, value in get_log_context().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+    return record
+
+
+# JsonFormatter {{{1
+class JsonFormatter(logging.Formatter):
+    """Format each record as a single line of json, so log indexers don't
+    have to parse the text logs.
+
+    Each line has the time, monotonic, logger, level, lineno (of the
+    logging call) and message, plus the action and command_id if they're
+    in the log context, and the exception if there is one.
+
+    Attributes:
+      encoder (json.JSONEncoder): a single compact encoder, reused for every
+        record.
+    """
+    def __init__(self):
+        super(JsonFormatter, self).__init__()
+        self.encoder = json.JSONEncoder(
+            ensure_ascii=False, check_circular=False, separators=(',', ':'),
+            default=six.text_type
+        )
+
+    def format(self, record):
+        add_log_context(record)
+        data = {
+            'time': record.created,
+            'monotonic': record.monotonic,
+            'logger': record.name,
+            'level': record.levelname,
+            'lineno': record.lineno,
+            'message': record.getMessage(),
+        }
+        for key in JSON_CONTEXT_KEYS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return self.encoder.encode(data)
+
 
 # logging helper methods {{{1
-def get_formatter(fmt=DEFAULT_FMT, datefmt=DEFAULT_DATEFMT):
+def get_formatter(fmt=DEFAULT_FMT, datefmt=DEFAULT_DATEFMT, cached=False):
     """Create a unicode-friendly formatter to add to logging handlers.
 
     Args:
       fmt (Optional[str]): logging message format.
       datefmt (Optional[str]): date format for the log message.
+      cached (Optional[bool]): if True, create a CachedFormatter.
 
     Returns:
       UnicodeFormatter to add to a handler - handler.setFormatter(formatter)
     """
+    if cached:
+        return CachedFormatter(fmt=fmt, datefmt=datefmt)
     formatter = UnicodeFormatter(fmt=fmt, datefmt=datefmt)
     return formatter
 
 
 def prepare_simple_logging(path, mode='w', logger_name='', level=DEFAULT_LEVEL,
-                           formatter=None):
+                           formatter=None, use_queue=False,
+                           queue_size=DEFAULT_QUEUE_SIZE,
+                           overflow=OVERFLOW_BLOCK, buffered=False,
+                           compression=None, compress_level=None,
+                           max_bytes=0, backup_count=0, json_path=None):
     """Create a unicode-friendly logger.
 
     By default it'll create the root logger with a console handler; if passed
@@ -77,7 +312,27 @@ def prepare_simple_logging(path, mode='w', logger_name='', level=DEFAULT_LEVEL,
       logger_name (Optional[str]): the name of the logger to use. Default ''
       level (Optional[int]): the level to log.  Default DEFAULT_LEVEL
       formatter (Optional[Formatter]): a logging Formatter to use; to handle
-        unicode, subclass UnicodeFormatter.
+        unicode, subclass UnicodeFormatter.  Defaults to a CachedFormatter
+        shared by both handlers.
+      use_queue (Optional[bool]): if True, send records to the console and
+        file handlers through a QueueHandler, so logging doesn't block on
+        slow output.  Default False
+      queue_size (Optional[int]): the max number of queued records, if
+        use_queue.  Default DEFAULT_QUEUE_SIZE
+      overflow (Optional[str]): what to do when the queue is full, if
+        use_queue; OVERFLOW_BLOCK or OVERFLOW_DROP.  Default OVERFLOW_BLOCK
+      buffered (Optional[bool]): if True, write the file log in batches
+        with a BufferedFileHandler.  Default False
+      compression (Optional[str]): COMPRESSION_GZIP or COMPRESSION_LZMA to
+        write a compressed file log.  Default None
+      compress_level (Optional[int]): the gzip compresslevel or lzma
+        preset.  Default DEFAULT_COMPRESS_LEVEL
+      max_bytes (Optional[int]): rotate the file log when it reaches
+        roughly this size, if backup_count is set.  Default 0
+      backup_count (Optional[int]): the number of old file logs to keep.
+        Default 0
+      json_path (Optional[str]): if set, also write a json lines log here,
+        with the same file options as the file log.  Default None
 
     Returns:
         logger (Logger object).  This is also easily retrievable via
@@ -85,14 +340,34 @@ def prepare_simple_logging(path, mode='w', logger_name='', level=DEFAULT_LEVEL,
     """
     logger = logging.getLogger(logger_name)
     logger.setLevel(level)
-    get_console_handler(logger=logger, level=level, formatter=formatter)
-    get_file_handler(path, logger=logger, mode=mode, level=level,
-                     formatter=formatter)
+    if not formatter:
+        formatter = get_formatter(cached=True)
+    handler_logger = None if use_queue else logger
+    handlers = [
+        get_console_handler(logger=handler_logger, level=level,
+                            formatter=formatter),
+        get_file_handler(path, logger=handler_logger, mode=mode, level=level,
+                         formatter=formatter, buffered=buffered,
+                         compression=compression,
+                         compress_level=compress_level, max_bytes=max_bytes,
+                         backup_count=backup_count),
+    ]
+    if json_path:
+        handlers.append(get_json_handler(
+            json_path, logger=handler_logger, mode=mode, level=level,
+            buffered=buffered, compression=compression,
+            compress_level=compress_level, max_bytes=max_bytes,
+            backup_count=backup_count
+        ))
+    if use_queue:
+        get_queue_handler(handlers, logger=logger, level=level,
+                          queue_size=queue_size, overflow=overflow)
     return logger
 
 
 def get_file_handler(path, level=logging.INFO, formatter=None,
-                     logger=None, mode='w'):
+                     logger=None, mode='w', buffered=False, compression=None,
+                     compress_level=None, max_bytes=0, backup_count=0):
     """Create a file handler to add to a logger.
 
     Args:
@@ -101,6 +376,16 @@ def get_file_handler(path, level=logging.INFO, formatter=None,
       formatter (Optional[logging.Formatter]): formatter to use for logs.
       logger (Optional[logging.Logger]): logger to add the file handler to.
       mode (Optional[str]): mode to open the file
+      buffered (Optional[bool]): if True, create a BufferedFileHandler that
+        writes records in batches.
+      compression (Optional[str]): if COMPRESSION_GZIP or COMPRESSION_LZMA,
+        create a CompressedFileHandler.  These are always buffered.
+      compress_level (Optional[int]): the gzip compresslevel or lzma preset.
+      max_bytes (Optional[int]): if set along with backup_count, rotate the
+        log when it reaches roughly this size.
+      backup_count (Optional[int]): the number of old logs to keep.  If this
+        is set and mode is 'w', the existing log is rotated rather than
+        truncated.
 
     Returns:
       handler (logging.FileHandler):  This can be added to a logger
@@ -109,7 +394,22 @@ def get_file_handler(path, level=logging.INFO, formatter=None,
     make_parent_dir(path, level=logging.DEBUG)
     if not formatter:
         formatter = get_formatter()
-    handler = logging.FileHandler(path, mode)
+    if mode.startswith('w'):
+        rotate_file(path, backup_count)
+    if compression:
+        handler = CompressedFileHandler(path, mode, compression=compression,
+                                        compress_level=compress_level,
+                                        max_bytes=max_bytes,
+                                        backup_count=backup_count)
+    elif buffered:
+        handler = BufferedFileHandler(path, mode, max_bytes=max_bytes,
+                                      backup_count=backup_count)
+    elif max_bytes and backup_count:
+        handler = logging.handlers.RotatingFileHandler(
+            path, 'a', maxBytes=max_bytes, backupCount=backup_count
+        )
+    else:
+        handler = logging.FileHandler(path, mode)
     handler.setLevel(level)
     handler.setFormatter(formatter)
     if logger:
@@ -139,6 +439,487 @@ def get_console_handler(formatter=None, logger=None, level=logging.INFO):
     return handler
 
 
+def get_json_handler(path, level=logging.INFO, logger=None, mode='w',
+                     **kwargs):
+    """Create a file handler that writes json lines, one per record, with
+    a JsonFormatter.
+
+    Args:
+      path (str): the path to the json log.
+      level (Optional[int]): logging level for the file.
+      logger (Optional[logging.Logger]): logger to add the handler to.
+      mode (Optional[str]): mode to open the file
+      **kwargs: sent to get_file_handler(), e.g. buffered or compression.
+
+    Returns:
+      handler (logging.FileHandler):  This can be added to a logger
+      via logger.addHandler(handler)
+    """
+    return get_file_handler(path, level=level, formatter=JsonFormatter(),
+                            logger=logger, mode=mode, **kwargs)
+
+
+def flush_handlers(logger):
+    """Flush the handlers of logger, and of each ancestor it propagates to.
+    This makes sure buffered and queued records are written.
+
+    Args:
+      logger (logging.Logger): the logger to flush.
+    """
+    while logger:
+        for handler in logger.handlers:
+            handler.flush()
+        if not logger.propagate:
+            break
+        logger = logger.parent
+
+
+def get_queue_handler(handlers, logger=None, level=logging.INFO,
+                      queue_size=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_BLOCK):
+    """Create a QueueHandler that sends records to handlers from a
+    background thread.
+
+    Args:
+      handlers (List[logging.Handler]): the handlers to send records to.
+        These shouldn't also be added to the logger.
+      logger (Optional[logging.Logger]): logger to add the queue handler to.
+      level (Optional[int]): logging level for the queue handler.
+      queue_size (Optional[int]): the max number of records to queue.
+      overflow (Optional[str]): OVERFLOW_BLOCK or OVERFLOW_DROP.
+
+    Returns:
+      QueueHandler handler.  This can be added to a logger via
+      logger.addHandler(handler)
+    """
+    handler = QueueHandler(handlers, queue_size=queue_size,
+                           overflow=overflow, level=level)
+    if logger:
+        logger.addHandler(handler)
+    return handler
+
+
+# BufferedFileHandler {{{1
+class BufferedFileHandler(logging.FileHandler):
+    """A FileHandler that collects formatted records and writes them in
+    batches.  logging.FileHandler flushes after every record, which is a
+    write() per line; this writes when the buffer reaches buffer_size
+    bytes, or when a record arrives flush_interval seconds after the last
+    write.
+
+    Records at flush_level and above are written immediately, along with
+    everything before them, so errors make it to disk even if the script
+    dies.  Scripts also flush all the log handlers in their post_run and
+    post_fatal listeners; see scriptharness.script.flush_log_handlers().
+
+    If max_bytes and backup_count are set, the file is rotated once this
+    handler has written max_bytes characters to it.  This is checked after
+    each write, so the file can go over max_bytes by up to one buffer.
+
+    Attributes:
+      buffer_size (int): the number of characters to collect before writing.
+
+      flush_interval (float): the max number of seconds between writes,
+        checked as each record arrives.
+
+      flush_level (int): records at this level or above are written
+        immediately.
+
+      pending (List[str]): the formatted records not yet written.
+
+      pending_size (int): the number of characters in pending.
+
+      last_flush (float): the time of the last write.
+
+      max_bytes (int): the number of characters to write before rotating.
+
+      backup_count (int): the number of rotated files to keep.
+
+      stream_size (int): the number of characters written to the current
+        file.
+    """
+    def __init__(self, filename, mode='a', encoding=None, delay=False,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_level=logging.ERROR, max_bytes=0, backup_count=0):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.stream_size = 0
+        self.pending = []
+        self.pending_size = 0
+        self.last_flush = time.time()
+        logging.FileHandler.__init__(self, filename, mode=mode,
+                                     encoding=encoding, delay=delay)
+
+    def emit(self, record):
+        """Format the record and add it to the buffer, writing the buffer if
+        needed.
+
+        Args:
+          record (logging.LogRecord): the record to log.
+        """
+        try:
+            message = self.format(record) + getattr(self, 'terminator', '\n')
+            self.pending.append(message)
+            self.pending_size += len(message)
+            if record.levelno >= self.flush_level or \
+                    self.pending_size >= self.buffer_size or \
+                    time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        """Write the buffered records to the file, and flush it.
+        """
+        self.acquire()
+        try:
+            if self.pending:
+                if self.stream is None:
+                    self.stream = self._open()
+                self.stream.write(''.join(self.pending))
+                self.stream_size += self.pending_size
+                self.pending = []
+                self.pending_size = 0
+            if self.stream is not None:
+                self.stream.flush()
+                if self.max_bytes and self.backup_count and \
+                        self.stream_size >= self.max_bytes:
+                    self.rotate()
+            self.last_flush = time.time()
+        finally:
+            self.release()
+
+    def rotate(self):
+        """Close the current file and rotate it.  The next write opens a new
+        file.
+        """
+        self.stream.close()
+        self.stream = None
+        self.stream_size = 0
+        rotate_file(self.baseFilename, self.backup_count)
+
+    def close(self):
+        """Write the buffered records, and close the file.
+        """
+        self.flush()
+        logging.FileHandler.close(self)
+
+
+# CompressedFileHandler {{{1
+def open_compressed(path, mode='r', compression=None, compress_level=None,
+                    encoding='utf-8'):
+    """Open a possibly-compressed text file.
+
+    Args:
+      path (str): the path to open.
+      mode (Optional[str]): 'r', 'w', or 'a'.  Default 'r'
+      compression (Optional[str]): COMPRESSION_GZIP, COMPRESSION_LZMA, or
+        None for plain text.  Default None
+      compress_level (Optional[int]): the gzip compresslevel or lzma preset,
+        when writing.  Default DEFAULT_COMPRESS_LEVEL
+      encoding (Optional[str]): the text encoding.  Default 'utf-8'
+
+    Returns:
+      file object: a text stream.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessException: on an unknown or
+        unavailable compression.
+    """
+    mode = mode.rstrip('bt')
+    if compression is None:
+        return io.open(path, mode, encoding=encoding)
+    if compress_level is None:
+        compress_level = DEFAULT_COMPRESS_LEVEL
+    if compression == COMPRESSION_GZIP:
+        if mode == 'r':
+            binary = gzip.open(path, 'rb')
+        else:
+            binary = gzip.open(path, mode + 'b', compresslevel=compress_level)
+    elif compression == COMPRESSION_LZMA and lzma is not None:
+        if mode == 'r':
+            binary = lzma.open(path, 'rb')
+        else:
+            binary = lzma.open(path, mode + 'b', preset=compress_level)
+    else:
+        raise ScriptHarnessException("Unknown compression!", compression)
+    return io.TextIOWrapper(binary, encoding=encoding)
+
+
+def open_log(path, encoding='utf-8'):
+    """Open a log file for reading, whether it's plain text or was written
+    by a CompressedFileHandler.  The compression is detected from the start
+    of the file, so the lines can be streamed back without decompressing
+    the whole file first::
+
+      with open_log("artifacts/log.txt.gz") as filehandle:
+          for line in filehandle:
+              ...
+
+    Args:
+      path (str): the path to the log.
+      encoding (Optional[str]): the text encoding.  Default 'utf-8'
+
+    Returns:
+      file object: a text stream.
+    """
+    with open(path, 'rb') as filehandle:
+        magic = filehandle.read(6)
+    compression = None
+    if magic.startswith(GZIP_MAGIC):
+        compression = COMPRESSION_GZIP
+    elif magic.startswith(LZMA_MAGIC):
+        compression = COMPRESSION_LZMA
+    return open_compressed(path, compression=compression, encoding=encoding)
+
+
+class CompressedFileHandler(BufferedFileHandler):
+    """A BufferedFileHandler that writes a gzip or lzma compressed file.
+    Writing in batches keeps the compressor from flushing every line.
+
+    Use open_log() to read the log back.
+
+    Attributes:
+      compression (str): COMPRESSION_GZIP or COMPRESSION_LZMA.
+      compress_level (int): the gzip compresslevel or lzma preset.
+    """
+    def __init__(self, filename, mode='a', compression=COMPRESSION_GZIP,
+                 compress_level=None, **kwargs):
+        self.compression = compression
+        self.compress_level = compress_level
+        kwargs.setdefault('encoding', 'utf-8')
+        BufferedFileHandler.__init__(self, filename, mode=mode, **kwargs)
+
+    def _open(self):
+        """Open the compressed stream.  This overrides
+        logging.FileHandler._open().
+
+        Returns:
+          file object: the text stream to write to.
+        """
+        return open_compressed(
+            self.baseFilename, mode=self.mode,
+            compression=self.compression,
+            compress_level=self.compress_level, encoding=self.encoding
+        )
+
+
+# QueueHandler {{{1
+class QueueHandler(logging.Handler):
+    """Hand log records off to a background thread, which sends them to the
+    real handlers.  This decouples reading command output from writing the
+    log: a slow terminal or network filesystem no longer stalls the thread
+    that drains the child process' pipe.
+
+    This combines logging.handlers.QueueHandler and QueueListener, which
+    aren't available in python 2.  Unlike those, the queue is bounded, and
+    overflow decides what happens when it fills up: OVERFLOW_BLOCK waits for
+    room, and OVERFLOW_DROP discards the record.  Records at logging.WARNING
+    and above are never dropped.  The number of dropped records is logged
+    once the queue has room again.
+
+    Attributes:
+      handlers (List[logging.Handler]): the handlers to send records to.
+
+      queue (six.moves.queue.Queue): the bounded queue of records.
+
+      overflow (str): OVERFLOW_BLOCK or OVERFLOW_DROP.
+
+      dropped (int): the number of records dropped since the last report.
+
+      thread (threading.Thread): the thread that sends records to handlers.
+    """
+    def __init__(self, handlers, queue_size=DEFAULT_QUEUE_SIZE,
+                 overflow=OVERFLOW_BLOCK, level=logging.NOTSET):
+        """Initialization method for QueueHandler.
+
+        Args:
+          handlers (List[logging.Handler]): the handlers to send records to.
+
+          queue_size (Optional[int]): the max number of records to queue.
+            Defaults to DEFAULT_QUEUE_SIZE.
+
+          overflow (Optional[str]): what to do when the queue is full;
+            OVERFLOW_BLOCK or OVERFLOW_DROP.  Defaults to OVERFLOW_BLOCK.
+
+          level (Optional[int]): the logging level of this handler.
+
+        Raises:
+          scriptharness.exceptions.ScriptHarnessException: on an unknown
+            overflow.
+        """
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP):
+            raise ScriptHarnessException(
+                "Unknown QueueHandler overflow!", overflow
+            )
+        super(QueueHandler, self).__init__(level=level)
+        self.handlers = list(handlers)
+        self.queue = Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.dropped = 0
+        self.drop_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.process_queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def prepare(record):
+        """Merge the record's args into its message before queueing it, so
+        later changes to mutable args don't change what gets logged.  The
+        log context is added here too, since it belongs to this thread.  The
+        rest of the formatting happens in the background thread.
+
+        Args:
+          record (logging.LogRecord): the record to prepare.
+
+        Returns:
+          logging.LogRecord: a copy of the record, with no args.
+        """
+        record = copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return add_log_context(record)
+
+    def emit(self, record):
+        """Queue the record for the background thread.
+
+        Args:
+          record (logging.LogRecord): the record to queue.
+        """
+        try:
+            record = self.prepare(record)
+            if self.overflow == OVERFLOW_BLOCK or \
+                    record.levelno >= logging.WARNING:
+                self.queue.put(record)
+                return
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                with self.drop_lock:
+                    self.dropped += 1
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def send(self, record):
+        """Send a record to each of the handlers at or below its level.
+
+        Args:
+          record (logging.LogRecord): the record to send.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def report_dropped(self):
+        """Log the number of dropped records, if any.
+        """
+        with self.drop_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.send(logging.makeLogRecord({
+                'name': LOGGER_NAME, 'levelno': logging.WARNING,
+                'levelname': logging.getLevelName(logging.WARNING),
+                'msg': "Dropped %d log records; the log queue was full.",
+                'args': (dropped, ),
+            }))
+
+    def process_queue(self):
+        """Send queued records to the handlers until we get END_OF_QUEUE.
+        This runs in self.thread.
+        """
+        while True:
+            record = self.queue.get()
+            try:
+                if record is END_OF_QUEUE:
+                    break
+                self.send(record)
+                if self.dropped and self.queue.empty():
+                    self.report_dropped()
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queued records to be sent, then flush the handlers.
+        """
+        if self.thread.is_alive():
+            self.queue.join()
+        self.report_dropped()
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        """Send the rest of the queued records and stop the thread.  The
+        handlers aren't closed, since logging.shutdown() closes them.
+        """
+        if self.thread.is_alive():
+            self.queue.put(END_OF_QUEUE)
+            self.thread.join()
+        self.report_dropped()
+        super(QueueHandler, self).close()
+
+
+# BufferedLogger {{{1
+class BufferedLogger(object):
+    """Stand in for a logging.Logger, holding the log calls until flush().
+
+    This lets a command running alongside others log contiguously, rather
+    than interleaving its lines with the other commands' output.  Several
+    BufferedLoggers can share a single records list, to keep the calls to
+    different loggers in order.
+
+    Attributes:
+      logger (logging.Logger): the logger to send the records to on flush().
+
+      records (List[Tuple[logging.Logger, int, str, tuple, dict]]): the
+        buffered log calls.
+    """
+    def __init__(self, logger, records=None):
+        self.logger = logger
+        if records is None:
+            records = []
+        self.records = records
+
+    def log(self, level, msg, *args, **kwargs):
+        """Buffer a logger.log() call.  The log context and time are saved
+        in `extra`, since they'll have changed by the time we flush.
+        """
+        extra = dict(get_log_context(), monotonic=monotonic())
+        extra.update(kwargs.get('extra') or {})
+        kwargs['extra'] = extra
+        self.records.append((self.logger, level, msg, args, kwargs))
+
+    def debug(self, msg, *args, **kwargs):
+        """Buffer a logger.debug() call."""
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        """Buffer a logger.info() call."""
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        """Buffer a logger.warning() call."""
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        """Buffer a logger.error() call."""
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        """Buffer a logger.critical() call."""
+        self.log(logging.CRITICAL, msg, *args, **kwargs)
+
+    def flush(self):
+        """Send all the buffered records to their loggers, in order.
+        """
+        records = self.records[:]
+        del self.records[:]
+        for logger, level, msg, args, kwargs in records:
+            logger.log(level, msg, *args, **kwargs)
+
+
 # LogMethod decorator {{{1
 class LogMethod(object):
     r"""Wrapper decorator object for logging and error detection.
@@ -292,6 +1073,31 @@ class LogMethod(object):
 
 
 # OutputBuffer {{{1
+class BufferedLine(object):
+    """A single line held in an OutputBuffer.
+
+    This uses __slots__ rather than a dict, since OutputBuffer can hold
+    hundreds of thousands of these over the life of a command.
+
+    Attributes:
+      level (int): the logging level to log the line at.
+
+      line (str): the line to log.
+
+      args (tuple): the args to send to logger.log() with the line.
+
+      time (float or None): the time the line was buffered, or None if
+        OutputBuffer isn't keeping timestamps.
+    """
+    __slots__ = ('level', 'line', 'args', 'time')
+
+    def __init__(self, level, line, args, timestamp=None):
+        self.level = level
+        self.line = line
+        self.args = args
+        self.time = timestamp
+
+
 class OutputBuffer(object):
     """Buffer output for context lines: essentially, an error_check can set
     the level of X lines in the past or Y lines in the future.  If multiple
@@ -308,19 +1114,38 @@ class OutputBuffer(object):
     way up until we match some other pattern, so the buffer had to grow to an
     arbitrary size.  Those could be represented by separate classes/subclasses
     if needed.
+
+    Attributes:
+      logger (logging.Logger): the logger to log the lines to.
+
+      pre_context_lines (int): the maximum number of lines to buffer.
+
+      post_context_lines (int): the maximum number of future lines an
+        error_check can set the level for.
+
+      timestamps (bool): whether to record the time each line was
+        buffered.  Skipping the time.time() call is cheaper when nothing
+        reads BufferedLine.time.
+
+      buffer (collections.deque): the BufferedLine objects not yet logged.
+
+      post_levels (collections.deque): the levels set for upcoming lines.
     """
-    def __init__(self, logger, pre_context_lines, post_context_lines):
+    def __init__(self, logger, pre_context_lines, post_context_lines,
+                 timestamps=True):
         self.logger = logger
         self.pre_context_lines = pre_context_lines
         self.post_context_lines = post_context_lines
-        # level, line, time
-        self.buffer = []
-        self.post_levels = []
+        self.timestamps = timestamps
+        self.buffer = deque()
+        self.post_levels = deque()
 
     def update_buffer_levels(self, level, pre_context_lines):
         """Set the level for each buffer line to level if it's higher than
         the existing level.
 
+        Only the affected lines at the end of the buffer are touched.
+
         Args:
           level (int):  The logging level to set the lines to
 
@@ -328,11 +1153,28 @@ class OutputBuffer(object):
             are relative to the current line, these will be counted backwards
             from the end of the buffer.
         """
-        start = max(len(self.buffer) - pre_context_lines, 0)
-        for position, buf in enumerate(self.buffer):
-            if position < start:
-                continue
-            self.buffer[position]['level'] = max(buf['level'], level)
+        for buf in islice(reversed(self.buffer), pre_context_lines):
+            if buf.level < level:
+                buf.level = level
+
+    def update_post_levels(self, level, post_context_lines):
+        """Set the level for the next post_context_lines lines to level if
+        it's higher than their existing level.
+
+        Args:
+          level (int):  The logging level to set the lines to
+
+          post_context_lines (int): The number of future lines to affect.
+        """
+        length = len(self.post_levels)
+        if length:
+            updated = [max(post_level, level) for post_level in
+                       islice(self.post_levels, post_context_lines)]
+            updated.extend(islice(self.post_levels, post_context_lines,
+                                  None))
+            self.post_levels = deque(updated)
+        if length < post_context_lines:
+            self.post_levels.extend([level] * (post_context_lines - length))
 
     def pop_buffer(self, num=1):
         """Pop num lines from the front of the buffer and log them at the
@@ -343,11 +1185,8 @@ class OutputBuffer(object):
             to 1.
         """
         for _ in range(0, num):
-            self.logger.log(
-                self.buffer[0]['level'], self.buffer[0]['line'],
-                *self.buffer[0]['args']
-            )
-            self.buffer.pop(0)
+            buf = self.buffer.popleft()
+            self.logger.log(buf.level, buf.line, *buf.args)
 
     def dump_buffer(self):
         """Write all the buffered log lines to the log.
@@ -373,26 +1212,19 @@ class OutputBuffer(object):
         post_context_lines = kwargs.get('post_context_lines')
         if self.post_context_lines:
             if self.post_levels:
-                current_level = max(current_level, self.post_levels.pop(0))
+                current_level = max(current_level,
+                                    self.post_levels.popleft())
             if post_context_lines:
-                for position, post_level in enumerate(self.post_levels):
-                    if position >= post_context_lines:
-                        break
-                    self.post_levels[position] = max(post_level, level)
-                length = len(self.post_levels)
-                if length < post_context_lines:
-                    for _ in range(length, post_context_lines):
-                        self.post_levels.append(level)
+                self.update_post_levels(level, post_context_lines)
         if self.pre_context_lines:
             if pre_context_lines and self.buffer:
                 self.update_buffer_levels(level, pre_context_lines)
-            self.buffer.append({
-                'level': current_level, 'line': line, 'args': args,
-                'time': time.time()
-            })
-            num_pop = max(len(self.buffer) - self.pre_context_lines, 0)
-            if num_pop > 0:
-                self.pop_buffer(num=num_pop)
+            self.buffer.append(BufferedLine(
+                current_level, line, args,
+                time.time() if self.timestamps else None
+            ))
+            if len(self.buffer) > self.pre_context_lines:
+                self.pop_buffer()
         else:
             self.logger.log(current_level, line, *args)
 
@@ -402,7 +1234,7 @@ class OutputParser(object):
     """Helper object to parse command output.
     """
 
-    def __init__(self, error_list, logger=None, **kwargs):
+    def __init__(self, error_list, logger=None, timestamps=True, **kwargs):
         """Initialization method for the OutputParser class
 
         Args:
@@ -411,6 +1243,9 @@ class OutputParser(object):
 
           logger (Optional[logging.Logger]): logger to use.  Defaults to None.
 
+          timestamps (Optional[bool]): whether the context buffer records
+            the time each line was buffered.  Defaults to True.
+
           **kwargs: These are ignored, and are here so we can subclass
             ParsedCommand.
         """
@@ -425,8 +1260,8 @@ class OutputParser(object):
         self.context_buffer = None
         if error_list.pre_context_lines or error_list.post_context_lines:
             self.context_buffer = OutputBuffer(
-                logger, error_list.pre_context_lines,
-                error_list.post_context_lines
+                self.logger, error_list.pre_context_lines,
+                error_list.post_context_lines, timestamps=timestamps
             )
 
     def add_buffer(self, level, messages, error_check=None):
@@ -435,13 +1270,16 @@ class OutputParser(object):
         Args:
           level (int): logging level to log the line at
 
-          line (str): line to log
+          messages (str or List[str]): the line(s) to log.  A str is split
+            on newlines.
 
           error_check (Optional[Dict[str, str or regex]]): the error_check in
             error_list that first matched line, if applicable.  Defaults to None.
         """
         error_check = error_check or {}
-        for line in messages.split('\n'):
+        if isinstance(messages, six.string_types):
+            messages = messages.split('\n')
+        for line in messages:
             if self.context_buffer:
                 self.context_buffer.add_line(
                     level, line,
@@ -458,34 +1296,40 @@ class OutputParser(object):
         self.history['worst_level'] = max(self.history['worst_level'],
                                           level)
 
+    def add_info_line(self, message):
+        """Log a line that didn't match any error_check.  This is the common
+        case, so it skips the error_check handling in add_buffer().
+
+        Args:
+          message (str): the message to log at logging.INFO
+        """
+        if self.context_buffer:
+            self.context_buffer.add_line(logging.INFO, message)
+        else:
+            self.logger.log(logging.INFO, message)
+        if self.history['worst_level'] < logging.INFO:
+            self.history['worst_level'] = logging.INFO
+
     def add_line(self, line):
         """parse a line and check if it matches one in `error_list`,
         if so then log it.
 
         Args:
-          line (str): a line of output to parse.
+          line (str or bytes): a line of output to parse.
         """
         line = to_unicode(line.rstrip())
-        for error_check in self.error_list:
-            match = False
-            if 'substr' in error_check:
-                if error_check['substr'] in line:
-                    match = True
-            elif error_check['regex'].search(line):
-                match = True
-            if match:
-                messages = [' %s' % line]
-                if error_check.get('explanation'):
-                    messages.append(' %s' % error_check['explanation'])
-                # exception default level is logging.ERROR
-                level = error_check.get('level', logging.ERROR)
-                if level >= 0:  # ignore negative levels
-                    self.add_buffer(level, '\n'.join(messages),
-                                    error_check=error_check)
-                if error_check.get('exception'):
-                    if self.context_buffer:
-                        self.context_buffer.dump_buffer()
-                    raise error_check['exception'](messages)
-                break
-        else:
-            self.add_buffer(logging.INFO, ' %s' % line, error_check=None)
+        error_check = self.error_list.match(line)
+        if error_check is None:
+            self.add_info_line(' %s' % line)
+            return
+        messages = [' %s' % line]
+        if error_check.get('explanation'):
+            messages.append(' %s' % error_check['explanation'])
+        # exception default level is logging.ERROR
+        level = error_check.get('level', logging.ERROR)
+        if level >= 0:  # ignore negative levels
+            self.add_buffer(level, messages, error_check=error_check)
+        if error_check.get('exception'):
+            if self.context_buffer:
+                self.context_buffer.dump_buffer()
+            raise error_check['exception'](messages)
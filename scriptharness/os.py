@@ -44,3 +44,35 @@ def make_parent_dir(path, **kwargs):
     dirname = os.path.dirname(path)
     if dirname:
         makedirs(dirname, **kwargs)
+
+
+def rotate_file(path, backup_count):
+    """Rotate path to path.1, path.1 to path.2, and so on, keeping at most
+    backup_count old copies.  Any copy past backup_count is removed.
+
+    This doesn't log, since it's used from inside log handlers.
+
+    Args:
+      path (str): path to the file.
+      backup_count (int): the number of old copies to keep.  If this is 0,
+        nothing is rotated.
+    """
+    if backup_count <= 0 or not os.path.exists(path):
+        return
+    for num in range(backup_count - 1, 0, -1):
+        source = "%s.%d" % (path, num)
+        if os.path.exists(source):
+            _replace(source, "%s.%d" % (path, num + 1))
+    _replace(path, "%s.1" % path)
+
+
+def _replace(source, destination):
+    """os.replace() for python 2: os.rename() won't overwrite on windows.
+
+    Args:
+      source (str): the path to move.
+      destination (str): the path to move it to.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
@@ -1,18 +1,47 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Scriptharness multiprocessing support.
+"""Scriptharness process support.
+
+Attributes:
+  READ_SIZE (int): the max number of bytes to read from a pipe at a time.
+  END_OF_OUTPUT (None): command_subprocess() puts this in the queue when
+    it's done, so watch_command() doesn't have to poll the runner.
+  LIVENESS_INTERVAL (float): the max number of seconds watch_command()
+    will block without checking whether the runner is still alive, in case
+    the runner died without sending END_OF_OUTPUT.
+  KILL_GRACE_PERIOD (float): the number of seconds kill_process_group()
+    waits after SIGTERM before sending SIGKILL.
+  CGROUP_ROOT (str): where the cgroup-v2 hierarchy is mounted.
+  CGROUP_PREFIX (str): the prefix of the cgroups we create, so
+    kill_runner() only ever kills cgroups that are ours.
 """
 from __future__ import absolute_import, division, print_function, \
     unicode_literals
+import codecs
+import errno
+import functools
 import os
 import psutil
 from psutil import NoSuchProcess
 from scriptharness.exceptions import ScriptHarnessError, ScriptHarnessFatal, \
     ScriptHarnessTimeout
-from six.moves.queue import Empty
+from six.moves.queue import Empty, Queue
+import signal
 import subprocess
 import sys
+import threading
 import time
+try:
+    import selectors
+except ImportError:  # py2
+    selectors = None
+
+READ_SIZE = 65536
+END_OF_OUTPUT = None
+LIVENESS_INTERVAL = 1.
+KILL_GRACE_PERIOD = 2.
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_PREFIX = "scriptharness-"
 
 
 def kill_proc_tree(pid, include_parent=False, wait=5):
@@ -40,12 +69,234 @@ def kill_proc_tree(pid, include_parent=False, wait=5):
         parent.wait(wait)
 
 
-def kill_runner(runner):
+def process_group_exists(pgid):
+    """Check whether there are any processes left in a process group.
+
+    Args:
+      pgid (int): the process group ID.
+
+    Returns:
+      bool: True if the group has any processes (including zombies).
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as exc_info:
+        return exc_info.errno == errno.EPERM
+    return True
+
+
+def kill_process_group(pgid, grace_period=KILL_GRACE_PERIOD, poll_cb=None):
+    """Kill every process in a process group with a single killpg(): send
+    SIGTERM, then SIGKILL whatever is left after grace_period seconds.
+
+    Unlike kill_proc_tree(), this doesn't have to find the children, so it
+    also gets any that are spawned while we're killing the others.
+    Processes that started their own session or process group escape; use
+    a cgroup for those.
+
+    Args:
+      pgid (int): the process group ID; the pid of the group leader.
+
+      grace_period (Optional[float]): the number of seconds to wait for
+        the group to exit after SIGTERM.  Defaults to KILL_GRACE_PERIOD.
+
+      poll_cb (Optional[Callable]): called while we wait, to reap the group
+        leader if it's our child, e.g. subprocess.Popen.poll.  A zombie
+        leader still counts as part of the group.  Defaults to None.
+    """
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + grace_period
+    while time.time() < deadline:
+        if poll_cb is not None:
+            poll_cb()
+        if not process_group_exists(pgid):
+            return
+        time.sleep(.01)
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+    if poll_cb is not None:
+        poll_cb()
+
+
+def get_popen_kwargs(cgroup=None):
+    """Get the subprocess.Popen kwargs to start a command as the leader of
+    its own session and process group, and optionally in a cgroup, so
+    kill_runner() can kill the whole thing at once.
+
+    Args:
+      cgroup (Optional[str]): the path of the cgroup to start the command
+        in; see create_cgroup().  Defaults to None.
+
+    Returns:
+      Dict[str, Any]: the kwargs.  This is empty on non-posix platforms.
+    """
+    if os.name != 'posix':
+        return {}
+    kwargs = {}
+    new_session = True
+    if sys.version_info >= (3, 2):
+        kwargs['start_new_session'] = True
+        new_session = False
+    if cgroup or new_session:
+        kwargs['preexec_fn'] = functools.partial(
+            prepare_child, cgroup=cgroup, new_session=new_session
+        )
+    return kwargs
+
+
+def prepare_child(cgroup=None, new_session=False):
+    """subprocess.Popen preexec_fn: this runs in the child, before exec.
+
+    Args:
+      cgroup (Optional[str]): the cgroup path to move the child into.
+
+      new_session (Optional[bool]): whether to call os.setsid().  This is
+        for pythons without Popen's start_new_session.
+    """
+    if new_session:
+        os.setsid()
+    if cgroup:
+        with open(os.path.join(cgroup, "cgroup.procs"), "w") as filehandle:
+            filehandle.write(str(os.getpid()))
+
+
+def create_cgroup(parent, name):
+    """Create a cgroup-v2 child cgroup to run a command in.
+
+    The parent needs to be a cgroup-v2 directory delegated to this user,
+    e.g. via systemd-run --user --scope -p Delegate=yes.
+
+    Args:
+      parent (str): the path of the parent cgroup.
+
+      name (str): the name of the new cgroup, minus CGROUP_PREFIX.
+
+    Returns:
+      str: the path of the new cgroup.
+
+    Raises:
+      OSError: if we can't create the cgroup.
+    """
+    path = os.path.join(parent, CGROUP_PREFIX + name)
+    os.mkdir(path)
+    return path
+
+
+def get_cgroup(pid):
+    """Find the cgroup-v2 path of a process, if it's a cgroup we created.
+
+    Args:
+      pid (int): the process ID.
+
+    Returns:
+      str: the cgroup path, or None if pid isn't in one of our cgroups.
+    """
+    try:
+        with open("/proc/%d/cgroup" % pid) as filehandle:
+            lines = filehandle.readlines()
+    except (IOError, OSError):
+        return None
+    for line in lines:
+        if line.startswith("0::"):
+            relative_path = line[3:].strip().lstrip("/")
+            if os.path.basename(relative_path).startswith(CGROUP_PREFIX):
+                return os.path.join(CGROUP_ROOT, relative_path)
+    return None
+
+
+def get_cgroup_pids(path):
+    """Get the pids in a cgroup.
+
+    Args:
+      path (str): the cgroup path.
+
+    Returns:
+      List[int]: the pids; empty if the cgroup is gone.
+    """
+    try:
+        with open(os.path.join(path, "cgroup.procs")) as filehandle:
+            return [int(pid) for pid in filehandle.read().split()]
+    except (IOError, OSError):
+        return []
+
+
+def write_cgroup_file(path, filename, value):
+    """Write a value to a cgroup control file.
+
+    Args:
+      path (str): the cgroup path.
+
+      filename (str): the control file, e.g. "cgroup.freeze".
+
+      value (str): the value to write.
+    """
+    with open(os.path.join(path, filename), "w") as filehandle:
+        filehandle.write(value)
+
+
+def kill_cgroup(path, wait=KILL_GRACE_PERIOD):
+    """Kill every process in a cgroup, then remove the cgroup.  Nothing in
+    the cgroup can escape, even by starting a new session.
+
+    We write to cgroup.kill where it exists (linux 5.14+).  Otherwise we
+    freeze the cgroup so nothing in it can fork, SIGKILL every process in
+    it, and thaw it so the kills are delivered.
+
+    Args:
+      path (str): the cgroup path.
+
+      wait (Optional[float]): the number of seconds to wait for the cgroup
+        to empty before removing it.  Defaults to KILL_GRACE_PERIOD.
+    """
+    try:
+        if os.path.exists(os.path.join(path, "cgroup.kill")):
+            write_cgroup_file(path, "cgroup.kill", "1")
+        else:
+            write_cgroup_file(path, "cgroup.freeze", "1")
+            for pid in get_cgroup_pids(path):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            write_cgroup_file(path, "cgroup.freeze", "0")
+    except (IOError, OSError):
+        return
+    deadline = time.time() + wait
+    while get_cgroup_pids(path) and time.time() < deadline:
+        time.sleep(.01)
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def kill_runner(runner, grace_period=KILL_GRACE_PERIOD):
     """Kill the runner process and children.
 
+    If the runner is in one of our cgroups, the cgroup is killed.  If it
+    leads its own process group (see get_popen_kwargs()), the group is
+    killed with kill_process_group().  Otherwise we fall back to finding
+    and killing its children with kill_proc_tree().
+
     Args:
-      runner (multiprocessing.Process): the process to kill.
+      runner (multiprocessing.Process or subprocess.Popen): the process to
+        kill.
+
+      grace_period (Optional[float]): the number of seconds between SIGTERM
+        and SIGKILL for process groups.  Defaults to KILL_GRACE_PERIOD.
     """
+    cgroup = get_cgroup(runner.pid)
+    if cgroup is not None:
+        kill_cgroup(cgroup, wait=grace_period)
+    if os.name == 'posix' and process_group_exists(runner.pid):
+        kill_process_group(runner.pid, grace_period=grace_period,
+                           poll_cb=getattr(runner, 'poll', None))
+        return
     try:
         kill_proc_tree(runner.pid, include_parent=True)
     except NoSuchProcess:
@@ -59,6 +310,8 @@ def command_subprocess(queue, *args, **kwargs):
 
     .. Note:: This is intended for non-binary output only.
 
+    END_OF_OUTPUT is put in the queue when we're done, even on error.
+
     Args:
       queue (multiprocessing.Queue): the queue to write to
       *args: sent to subprocess.Popen
@@ -68,25 +321,71 @@ def command_subprocess(queue, *args, **kwargs):
     kwargs['stderr'] = subprocess.STDOUT
     kwargs['bufsize'] = 0
     try:
-        handle = subprocess.Popen(*args, **kwargs)
-    except OSError as exc_info:
-        raise ScriptHarnessError("Can't run command!", args, exc_info)
-    loop = True
-    while loop:
-        if handle.poll() is not None:
-            loop = False
+        try:
+            handle = subprocess.Popen(*args, **kwargs)
+        except OSError as exc_info:
+            raise ScriptHarnessError("Can't run command!", args, exc_info)
         while True:
             line = handle.stdout.readline()
             if not line:
                 break
             queue.put(line)
+        handle.wait()
+    finally:
+        queue.put(END_OF_OUTPUT)
+    sys.exit(handle.returncode)
+
+
+def batched_command_subprocess(queue, *args, **kwargs):
+    """Like command_subprocess(), but read the output in large chunks and
+    put lists of lines in the queue, rather than a single line per put().
+    This cuts the per-line locking and pickling overhead for chatty
+    commands.  Use this with watch_command() for timeout support.
+
+    .. Note:: This is intended for non-binary output only.  Lines are
+       sent without their trailing newline.
+
+    END_OF_OUTPUT is put in the queue when we're done, even on error.
+
+    Args:
+      queue (multiprocessing.Queue): the queue to write to
+      *args: sent to subprocess.Popen
+      **kwargs: sent to subprocess.Popen
+    """
+    kwargs['stdout'] = subprocess.PIPE
+    kwargs['stderr'] = subprocess.STDOUT
+    kwargs['bufsize'] = 0
+    splitter = LineSplitter()
+    try:
+        try:
+            handle = subprocess.Popen(*args, **kwargs)
+        except OSError as exc_info:
+            raise ScriptHarnessError("Can't run command!", args, exc_info)
+        while True:
+            chunk = os.read(handle.stdout.fileno(), READ_SIZE)
+            if not chunk:
+                break
+            lines = splitter.split(chunk)
+            if lines:
+                queue.put(lines)
+        lines = splitter.flush()
+        if lines:
+            queue.put(lines)
+        handle.wait()
+    finally:
+        queue.put(END_OF_OUTPUT)
     sys.exit(handle.returncode)
 
 
 def watch_command(logger, queue, runner,  # pylint: disable=too-many-arguments
-                  add_line_cb, max_timeout=None, output_timeout=None):
+                  add_line_cb, max_timeout=None, output_timeout=None,
+                  add_lines_cb=None):
     """This function watches the queue of the command_subprocess process.
 
+    We block on the queue until we get a line, END_OF_OUTPUT, or hit the
+    nearest timeout, rather than polling.  The runner's liveness is only
+    checked every LIVENESS_INTERVAL seconds of silence.
+
     Usage::
 
       queue = multiprocessing.Queue()
@@ -112,6 +411,10 @@ def watch_command(logger, queue, runner,  # pylint: disable=too-many-arguments
         killed if it doesn't produce any output for this number of seconds.
         Default: None
 
+      add_lines_cb (Optional[Callable[[List[str]]]]): batches of lines from
+        batched_command_subprocess() will be sent here.  If None, each line
+        of the batch is sent to add_line_cb.  Default: None
+
     Returns:
       runner.exitcode (int): on non-timeout.
 
@@ -123,11 +426,15 @@ def watch_command(logger, queue, runner,  # pylint: disable=too-many-arguments
     """
     last_output = start_time = time.time()
     while True:
+        timeout = check_timeouts(
+            logger, runner, start_time, last_output,
+            max_timeout=max_timeout, output_timeout=output_timeout
+        )
+        if timeout is None or timeout > LIVENESS_INTERVAL:
+            timeout = LIVENESS_INTERVAL
         empty = False
         try:
-            line = queue.get(block=True, timeout=.001)
-            add_line_cb(line)
-            last_output = time.time()
+            line = queue.get(block=True, timeout=timeout)
         except KeyboardInterrupt:
             logger.warning("KeyboardInterrupt: Killing processes!")
             kill_proc_tree(os.getpid(), include_parent=True)
@@ -139,22 +446,28 @@ def watch_command(logger, queue, runner,  # pylint: disable=too-many-arguments
         if empty:
             if not runner.is_alive():
                 return runner.exitcode
-            now = time.time()
-            if output_timeout and (last_output + output_timeout < now):
-                message = "%d seconds without output!" % output_timeout
-                logger.error(message + "  Killing process...")
-                kill_runner(runner)
-                raise ScriptHarnessTimeout(message)
-            if max_timeout and (start_time + max_timeout < now):
-                message = "Hit max timeout of %d seconds!" % max_timeout
-                logger.error(message + "  Killing process...")
-                kill_runner(runner)
-                raise ScriptHarnessTimeout(message)
+        elif line is END_OF_OUTPUT:
+            runner.join()
+            return runner.exitcode
+        else:
+            if not isinstance(line, list):
+                add_line_cb(line)
+            elif add_lines_cb is not None:
+                add_lines_cb(line)
+            else:
+                for item in line:
+                    add_line_cb(item)
+            last_output = time.time()
 
 
 def watch_output(logger, runner, stdout,  # pylint: disable=too-many-arguments
                  stderr, max_timeout=None, output_timeout=None):
-    """This function watches the queue of the output_subprocess process.
+    """This function watches a process that writes directly to the stdout
+    and stderr files, polling the file mtimes for output_timeout.
+
+    Output.run() now uses watch_pipes() to tee the output into the files
+    instead, which tracks output and process exit precisely; this is here
+    for callers that hand the files straight to subprocess.Popen.
 
     Usage::
 
@@ -204,3 +517,420 @@ def watch_output(logger, runner, stdout,  # pylint: disable=too-many-arguments
             runner.kill()
             raise ScriptHarnessTimeout(message)
         time.sleep(.1)
+
+
+# Direct pipe reading {{{1
+class LineSplitter(object):
+    """Split chunks of output into lines, holding any partial line until
+    the rest of it arrives.
+
+    Lines are split on newlines, like readline(), and are returned without
+    the trailing newline.
+
+    If encoding is set, each chunk is decoded with an incremental decoder
+    before it's split, so the whole chunk is decoded at once rather than
+    line by line, and a multi-byte character split across two reads is
+    decoded correctly.
+
+    Attributes:
+      partial (bytes or str): the incomplete last line seen so far.
+
+      decoder (codecs.IncrementalDecoder): the decoder, or None if we're
+        returning bytes.
+
+      encoding (str): the encoding, or None if we're returning bytes.
+
+      errors (str): the codecs error handler.
+    """
+    def __init__(self, encoding=None, errors='strict'):
+        """Initialization method for LineSplitter.
+
+        Args:
+          encoding (Optional[str]): the encoding to decode the output with.
+            If None, lines are returned as bytes.  Defaults to None.
+
+          errors (Optional[str]): the codecs error handler to decode with,
+            e.g. 'strict', 'replace', or 'ignore'.  Defaults to 'strict'.
+        """
+        self.encoding = encoding
+        self.errors = errors
+        if encoding is None:
+            self.decoder = None
+            self.partial = b''
+            self.newline = b'\n'
+        else:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+            self.partial = ''
+            self.newline = '\n'
+
+    def copy(self):
+        """Get a new LineSplitter with the same encoding and errors, for
+        splitting another stream of output.
+
+        Returns:
+          LineSplitter: the new splitter, with nothing buffered.
+        """
+        return LineSplitter(encoding=self.encoding, errors=self.errors)
+
+    def split(self, chunk):
+        """Split a chunk of output into complete lines.
+
+        Args:
+          chunk (bytes): output read from the pipe.
+
+        Returns:
+          List[bytes or str]: the complete lines.
+        """
+        if self.decoder is not None:
+            chunk = self.decoder.decode(chunk)
+        end = chunk.rfind(self.newline)
+        if end < 0:
+            self.partial += chunk
+            return []
+        lines = (self.partial + chunk[:end]).split(self.newline)
+        self.partial = chunk[end + 1:]
+        return lines
+
+    def flush(self):
+        """Return the remaining partial line, if any.
+
+        Returns:
+          List[bytes or str]: the partial line, or an empty list.
+        """
+        if self.decoder is not None:
+            self.partial += self.decoder.decode(b'', final=True)
+        lines = []
+        if self.partial:
+            lines.append(self.partial)
+            self.partial = self.partial[:0]
+        return lines
+
+
+class SelectorReader(object):
+    """Read from multiple pipes in this process, using selectors to wait for
+    output.  This is posix-only; windows selectors only support sockets.
+
+    Attributes:
+      selector (selectors.BaseSelector): the selector the pipes are
+        registered with.
+
+      num_open (int): the number of pipes that haven't hit EOF.
+    """
+    def __init__(self, pipes):
+        self.selector = selectors.DefaultSelector()
+        for pipe in pipes:
+            self.selector.register(pipe, selectors.EVENT_READ)
+        self.num_open = len(pipes)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for output.
+
+        Args:
+          timeout (Optional[float]): the max number of seconds to wait.
+            Wait forever if None.
+
+        Returns:
+          List[Tuple[file, bytes]]: the pipes that had output, and the output.
+        """
+        chunks = []
+        for key, _ in self.selector.select(timeout):
+            chunk = os.read(key.fd, READ_SIZE)
+            if chunk:
+                chunks.append((key.fileobj, chunk))
+            else:
+                self.selector.unregister(key.fileobj)
+                self.num_open -= 1
+        return chunks
+
+    def close(self):
+        """Close the selector.
+        """
+        self.selector.close()
+
+
+class ThreadedReader(object):
+    """Read from multiple pipes using a thread per pipe, for platforms where
+    we can't select() on pipes.
+
+    Attributes:
+      queue (Queue): the reader threads put (pipe, chunk) tuples here.  An
+        empty chunk means EOF.
+
+      num_open (int): the number of pipes that haven't hit EOF.
+    """
+    def __init__(self, pipes):
+        self.queue = Queue()
+        self.num_open = len(pipes)
+        for pipe in pipes:
+            thread = threading.Thread(target=self.read_pipe, args=(pipe, ))
+            thread.daemon = True
+            thread.start()
+
+    def read_pipe(self, pipe):
+        """Thread target: read from pipe until EOF.
+
+        Args:
+          pipe (file): the pipe to read from.
+        """
+        while True:
+            chunk = os.read(pipe.fileno(), READ_SIZE)
+            self.queue.put((pipe, chunk))
+            if not chunk:
+                break
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for output.
+
+        Args:
+          timeout (Optional[float]): the max number of seconds to wait.
+            Wait forever if None.
+
+        Returns:
+          List[Tuple[file, bytes]]: the pipes that had output, and the output.
+        """
+        chunks = []
+        try:
+            item = self.queue.get(block=True, timeout=timeout)
+            while True:
+                if item[1]:
+                    chunks.append(item)
+                else:
+                    self.num_open -= 1
+                item = self.queue.get(block=False)
+        except Empty:
+            pass
+        return chunks
+
+    def close(self):
+        """Nothing to close; the threads exit on EOF.
+        """
+        assert self
+
+
+def get_pipe_reader(pipes):
+    """Get the best available reader object for this platform.
+
+    Args:
+      pipes (List[file]): the pipes to read from.
+
+    Returns:
+      SelectorReader or ThreadedReader
+    """
+    if selectors is not None and os.name != 'nt':
+        return SelectorReader(pipes)
+    return ThreadedReader(pipes)
+
+
+def find_timeout(start_time, last_output, max_timeout=None,
+                 output_timeout=None):
+    """Find whether we've hit a timeout, and if not, how long until the
+    nearest one.
+
+    Args:
+      start_time (float): when the runner started.
+
+      last_output (float): when the runner last produced output.
+
+      max_timeout (Optional[int]): the max number of seconds the runner can
+        run.  Default: None
+
+      output_timeout (Optional[int]): the max number of seconds the runner
+        can run without output.  Default: None
+
+    Returns:
+      Tuple[str, float]: (message, remaining).  message is the timeout
+        message if we've hit a timeout, else None.  remaining is the number
+        of seconds until the nearest timeout, or None if there are no
+        timeouts.
+    """
+    now = time.time()
+    remaining = []
+    if output_timeout:
+        if last_output + output_timeout < now:
+            return "%d seconds without output!" % output_timeout, 0
+        remaining.append(last_output + output_timeout - now)
+    if max_timeout:
+        if start_time + max_timeout < now:
+            return "Hit max timeout of %d seconds!" % max_timeout, 0
+        remaining.append(start_time + max_timeout - now)
+    if remaining:
+        return None, min(remaining)
+    return None, None
+
+
+def check_timeouts(logger, runner, start_time, last_output,
+                   max_timeout=None, output_timeout=None):
+    """Kill the runner and raise if we've hit a timeout.  Otherwise, return
+    the number of seconds until the nearest timeout.
+
+    Args:
+      logger (logging.Logger): the logger to use.
+
+      runner (multiprocessing.Process or subprocess.Popen): the process to
+        kill on timeout.
+
+      start_time (float): when the runner started.
+
+      last_output (float): when the runner last produced output.
+
+      max_timeout (Optional[int]): the max number of seconds the runner can
+        run.  Default: None
+
+      output_timeout (Optional[int]): the max number of seconds the runner
+        can run without output.  Default: None
+
+    Returns:
+      float: the number of seconds until the nearest timeout, or None if
+        there are no timeouts.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessTimeout: on output_timeout or
+        max_timeout.
+    """
+    message, remaining = find_timeout(
+        start_time, last_output, max_timeout=max_timeout,
+        output_timeout=output_timeout
+    )
+    if message:
+        logger.error(message + "  Killing process...")
+        kill_runner(runner)
+        raise ScriptHarnessTimeout(message)
+    return remaining
+
+
+def watch_pipes(logger, process, callbacks,  # pylint: disable=too-many-arguments
+                max_timeout=None, output_timeout=None):
+    """Read the process' pipes directly in this process, sending each chunk
+    of output to the matching callback, until all pipes hit EOF and the
+    process exits.
+
+    We sleep until we either get output or hit the nearest timeout, so a
+    quiet command doesn't use any cpu.  The pipes are closed on return.
+
+    Usage::
+
+      process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, bufsize=0)
+      watch_pipes(logger, process, {process.stdout: read_cb},
+                  output_timeout=output_timeout, max_timeout=max_timeout)
+
+    Args:
+      logger (logging.Logger): the logger to use.
+
+      process (subprocess.Popen): the process to watch.
+
+      callbacks (Dict[file, Callable[[bytes]]]): pipe to callback mapping.
+        Each chunk of output read from a pipe is sent to its callback.
+
+      max_timeout (Optional[int]): when specified, the process will be killed
+        if it takes longer than this number of seconds.  Default: None
+
+      output_timeout (Optional[int]): when specified, the process will be
+        killed if it doesn't produce any output for this number of seconds.
+        Default: None
+
+    Returns:
+      process.returncode (int): on non-timeout.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: on KeyboardInterrupt
+
+      scriptharness.exceptions.ScriptHarnessTimeout: on output_timeout or
+        max_timeout.
+    """
+    last_output = start_time = time.time()
+    reader = get_pipe_reader(list(callbacks.keys()))
+    try:
+        while reader.num_open:
+            timeout = check_timeouts(
+                logger, process, start_time, last_output,
+                max_timeout=max_timeout, output_timeout=output_timeout
+            )
+            chunks = reader.read(timeout=timeout)
+            for pipe, chunk in chunks:
+                callbacks[pipe](chunk)
+            if chunks:
+                last_output = time.time()
+        # The pipes can close before the process exits.
+        while process.poll() is None:
+            timeout = check_timeouts(
+                logger, process, start_time, last_output,
+                max_timeout=max_timeout, output_timeout=output_timeout
+            )
+            time.sleep(min(timeout or .01, .01))
+    except KeyboardInterrupt:
+        logger.warning("KeyboardInterrupt: Killing processes!")
+        kill_runner(process)
+        raise ScriptHarnessFatal("KeyboardInterrupt")
+    finally:
+        reader.close()
+        for pipe in callbacks:
+            pipe.close()
+    return process.returncode
+
+
+def watch_pipe(logger, process, add_line_cb,  # pylint: disable=too-many-arguments
+               max_timeout=None, output_timeout=None, add_lines_cb=None,
+               splitter=None):
+    """Read process.stdout directly in this process, sending each line of
+    output to add_line_cb.  This is the line-based wrapper around
+    watch_pipes(), and replaces the command_subprocess() +
+    watch_command() pair without the extra process or queue.
+
+    .. Note:: This is intended for non-binary output only.
+
+    Args:
+      logger (logging.Logger): the logger to use.
+
+      process (subprocess.Popen): the process to watch.  stdout must be a
+        pipe; stderr will generally be subprocess.STDOUT.
+
+      add_line_cb (Callable[[bytes]]): any output lines read will be sent
+        here.
+
+      max_timeout (Optional[int]): when specified, the process will be killed
+        if it takes longer than this number of seconds.  Default: None
+
+      output_timeout (Optional[int]): when specified, the process will be
+        killed if it doesn't produce any output for this number of seconds.
+        Default: None
+
+      add_lines_cb (Optional[Callable[[List[bytes]]]]): when specified, all
+        the lines read in a single chunk are sent here as a list, instead of
+        to add_line_cb one at a time.  Default: None
+
+      splitter (Optional[LineSplitter]): the LineSplitter to split (and
+        optionally decode) the output with.  If None, lines are sent as
+        bytes.  Default: None
+
+    Returns:
+      process.returncode (int): on non-timeout.
+
+    Raises:
+      scriptharness.exceptions.ScriptHarnessFatal: on KeyboardInterrupt
+
+      scriptharness.exceptions.ScriptHarnessTimeout: on output_timeout or
+        max_timeout.
+    """
+    if splitter is None:
+        splitter = LineSplitter()
+    if add_lines_cb is None:
+        def add_lines_cb(lines):
+            """Send each line to add_line_cb."""
+            for line in lines:
+                add_line_cb(line)
+
+    def read_cb(chunk):
+        """Split the chunk into lines for add_lines_cb."""
+        lines = splitter.split(chunk)
+        if lines:
+            add_lines_cb(lines)
+
+    return_value = watch_pipes(
+        logger, process, {process.stdout: read_cb},
+        max_timeout=max_timeout, output_timeout=output_timeout
+    )
+    lines = splitter.flush()
+    if lines:
+        add_lines_cb(lines)
+    return return_value
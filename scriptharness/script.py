@@ -21,9 +21,10 @@ import logging
 import os
 import pprint
 from scriptharness.actions import Action
-from scriptharness.os import make_parent_dir
+from scriptharness.os import make_parent_dir, rotate_file
 import scriptharness.config as shconfig
 from scriptharness.exceptions import ScriptHarnessException, ScriptHarnessFatal
+from scriptharness.log import flush_handlers, log_context
 from scriptharness.structures import iterate_pairs, LoggingDict, ReadOnlyDict
 import sys
 import time
@@ -51,19 +52,33 @@ phases, Context.action is None.
 
 
 # Helper functions {{{1
-def save_config(config, path):
+def save_config(config, path, backup_count=0):
     """Save the configuration file to path as json.
 
     Args:
       config (Dict[str, str]): The config to save
       path (str): The path to write the config to
+      backup_count (Optional[int]): rotate an existing file at path to
+        path.1, path.1 to path.2, etc., keeping this many old copies.
+        Defaults to 0, which overwrites path.
     """
     make_parent_dir(path)
-    # log rotation would be nice.
+    rotate_file(path, backup_count)
     with codecs.open(path, 'w', encoding='utf-8') as filehandle:
         filehandle.write(json.dumps(config, sort_keys=True, indent=4))
 
 
+def flush_log_handlers(context):
+    """Flush the script's log handlers, so buffered and queued log records
+    are written even if the script is about to die.  Script adds this as
+    a post_run and post_fatal listener.
+
+    Args:
+      context (Context): the context from the script.
+    """
+    flush_handlers(context.logger)
+
+
 def build_context(script, phase, action=None):
     """Build context for functions called by Actions.
 
@@ -160,6 +175,8 @@ class Script(object):
         self.verify_actions(actions)
         self.build_config(template, **kwargs)
         self.logger = self.get_logger()
+        self.add_listener(flush_log_handlers, POST_RUN)
+        self.add_listener(flush_log_handlers, POST_FATAL)
         self.start_message()
         self.log_enabled_actions()
         self.save_config()
@@ -199,7 +216,8 @@ class Script(object):
             self.config,
             os.path.join(
                 self.config['scriptharness_artifact_dir'], "localconfig.json"
-            )
+            ),
+            backup_count=self.config.get('scriptharness_config_backups', 0)
         )
 
     def dict_to_config(self, config):
@@ -304,28 +322,30 @@ class Script(object):
         if not action.enabled:
             logger.info(action.strings['skip_message'], repl_dict)
             return
-        context = build_context(self, PRE_ACTION, action=action)
-        for listener, actions in iterate_pairs(self.listeners[PRE_ACTION]):
-            if actions and action.name not in actions:
-                continue
-            listener(context)
-        logger.info(action.strings['run_message'], repl_dict)
-        try:
-            context = build_context(self, RUN_ACTION, action=action)
-            action.run(context)
-        except ScriptHarnessFatal:
-            context = build_context(self, POST_FATAL, action=action)
+        with log_context(action=action.name):
+            context = build_context(self, PRE_ACTION, action=action)
+            for listener, actions in iterate_pairs(self.listeners[PRE_ACTION]):
+                if actions and action.name not in actions:
+                    continue
+                listener(context)
+            logger.info(action.strings['run_message'], repl_dict)
+            try:
+                context = build_context(self, RUN_ACTION, action=action)
+                action.run(context)
+            except ScriptHarnessFatal:
+                context = build_context(self, POST_FATAL, action=action)
+                for listener, actions in \
+                        iterate_pairs(self.listeners['post_fatal']):
+                    if actions and action.name not in actions:
+                        continue
+                    listener(context)
+                raise
+            context = build_context(self, POST_ACTION, action=action)
             for listener, actions in \
-                    iterate_pairs(self.listeners['post_fatal']):
+                    iterate_pairs(self.listeners['post_action']):
                 if actions and action.name not in actions:
                     continue
                 listener(context)
-            raise
-        context = build_context(self, POST_ACTION, action=action)
-        for listener, actions in iterate_pairs(self.listeners['post_action']):
-            if actions and action.name not in actions:
-                continue
-            listener(context)
 
     def get_logger(self):
         """Get a logger to log messages.
@@ -333,8 +353,10 @@ class Script(object):
         This is not strictly needed, as python's logging module will
         keep track of these loggers.
 
-        However, if we support structured logging as well as python logging,
-        get_logger() may return one or the other depending on config.
+        Structured logging is done with a scriptharness.log.JsonFormatter
+        handler on the same python logger (see the json_path option of
+        scriptharness.log.prepare_simple_logging()); while each action runs,
+        its name is in the log context.
 
         This method may end up moving to the scriptharness module, and tracked
         in ScriptManager.
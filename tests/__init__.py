@@ -53,13 +53,15 @@ class LoggerReplacement(object):
         self.level_messages = {}
         self.simple = simple
 
-    def log(self, level, msg, *args):
+    def log(self, level, msg, *args, **kwargs):
         """Keep track of all calls to logger.log()
 
         self.all_messages gets a list of all (level, msg, *args).
         self.level_messages is a dict, with level keys; the values are lists
-        containing tuples of (msg, args) per log() call.
+        containing tuples of (msg, args) per log() call.  kwargs, like
+        `extra`, are ignored.
         """
+        assert kwargs is not None  # silence pylint
         if self.simple:
             if args:
                 msg = msg % args[0]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test scriptharness/asynccommands.py
+"""
+from __future__ import absolute_import, division, print_function, \
+                       unicode_literals
+import logging
+from scriptharness.errorlists import ErrorList
+from scriptharness.exceptions import ScriptHarnessError, \
+    ScriptHarnessFatal, ScriptHarnessTimeout
+import scriptharness.log as log
+import scriptharness.status as status
+import sys
+import time
+import unittest
+from . import LoggerReplacement
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    import scriptharness.asynccommands as asynccommands
+
+TEST_COMMAND = [
+    sys.executable, "-c",
+    'from __future__ import print_function; print("hello");'
+]
+SLEEP_COMMAND = [sys.executable, "-c", "import time;time.sleep(300);"]
+
+
+def run_async(coroutine):
+    """Run a coroutine to completion in a new event loop."""
+    return asyncio.run(coroutine)
+
+
+# TestAsyncCommand {{{1
+@unittest.skipIf(sys.version_info < (3, 7), "asyncio requires python 3.7+")
+class TestAsyncCommand(unittest.TestCase):
+    """Test AsyncCommand and async_run()
+    """
+    def test_simple_command(self):
+        """test_asynccommands | simple AsyncCommand.run()
+        """
+        logger = LoggerReplacement()
+        command = asynccommands.AsyncCommand(TEST_COMMAND, logger=logger)
+        self.assertEqual(run_async(command.run()), status.SUCCESS)
+        self.assertEqual(logger.all_messages[-1][2][0], "hello")
+        self.assertEqual(command.history['return_value'], 0)
+
+    def test_error(self):
+        """test_asynccommands | AsyncCommand.run() error
+        """
+        command = asynccommands.AsyncCommand(
+            [sys.executable, "-c", "import sys; sys.exit(1)"],
+            logger=LoggerReplacement()
+        )
+        self.assertRaises(ScriptHarnessError, run_async, command.run())
+
+    def test_nonexistent_command(self):
+        """test_asynccommands | AsyncCommand nonexistent command
+        """
+        command = asynccommands.AsyncCommand(
+            ["this_command_should_not_exist"], logger=LoggerReplacement()
+        )
+        self.assertRaises(ScriptHarnessError, run_async, command.run())
+
+    def test_timeouts(self):
+        """test_asynccommands | AsyncCommand output_timeout and timeout
+        """
+        for kwargs in ({'output_timeout': .5}, {'timeout': .5}):
+            now = time.time()
+            command = asynccommands.AsyncCommand(
+                SLEEP_COMMAND, logger=LoggerReplacement(), **kwargs
+            )
+            self.assertRaises(ScriptHarnessTimeout, run_async, command.run())
+            self.assertTrue(now + 1.5 > time.time())
+
+    def test_concurrent(self):
+        """test_asynccommands | concurrent async_run()
+        """
+        command = [sys.executable, "-c", "import time;time.sleep(.5)"]
+
+        async def run_all():
+            """Run several commands at once"""
+            return await asyncio.gather(*[
+                asynccommands.async_run(command, logger=LoggerReplacement())
+                for _ in range(4)
+            ])
+        now = time.time()
+        cmds = run_async(run_all())
+        self.assertTrue(now + 1.5 > time.time())
+        for cmd in cmds:
+            self.assertEqual(cmd.history['status'], status.SUCCESS)
+
+    def test_async_run_halt(self):
+        """test_asynccommands | async_run() halt_on_failure
+        """
+        self.assertRaises(
+            ScriptHarnessFatal, run_async,
+            asynccommands.async_run(["this_command_should_not_exist"],
+                                    halt_on_failure=True,
+                                    logger=LoggerReplacement())
+        )
+        cmd = run_async(asynccommands.async_run(
+            SLEEP_COMMAND, timeout=.1, logger=LoggerReplacement()
+        ))
+        self.assertEqual(cmd.history['status'], status.TIMEOUT)
+
+    def test_async_parse(self):
+        """test_asynccommands | async_parse()
+        """
+        error_list = ErrorList([
+            {'substr': 'ell', 'level': logging.WARNING}
+        ])
+        logger = LoggerReplacement()
+        parser = log.OutputParser(error_list, logger=logger)
+        cmd = run_async(asynccommands.async_parse(TEST_COMMAND,
+                                                  parser=parser))
+        self.assertTrue(isinstance(cmd, asynccommands.AsyncParsedCommand))
+        self.assertEqual(parser.history['num_warnings'], 1)
+        self.assertEqual(logger.all_messages,
+                         [(logging.WARNING, ' hello', ())])
+
+
+# TestAsyncOutput {{{1
+@unittest.skipIf(sys.version_info < (3, 7), "asyncio requires python 3.7+")
+class TestAsyncOutput(unittest.TestCase):
+    """Test AsyncOutput and async_get_text_output()
+    """
+    def test_get_text_output(self):
+        """test_asynccommands | async_get_text_output()
+        """
+        output = run_async(asynccommands.async_get_text_output(
+            TEST_COMMAND, logger=LoggerReplacement()
+        ))
+        self.assertEqual(output, "hello")
+
+    def test_stderr(self):
+        """test_asynccommands | AsyncOutput stderr
+        """
+        cmd = asynccommands.AsyncOutput(
+            [sys.executable, "-c", "import sys;sys.stderr.write('err')"],
+            logger=LoggerReplacement()
+        )
+        try:
+            run_async(cmd.run())
+            self.assertEqual(cmd.get_output(), "")
+            self.assertEqual(cmd.get_output(handle_name="stderr"), "err")
+        finally:
+            cmd.cleanup()
+
+    def test_halt(self):
+        """test_asynccommands | async_get_text_output() halt_on_failure
+        """
+        self.assertRaises(
+            ScriptHarnessFatal, run_async,
+            asynccommands.async_get_text_output(
+                SLEEP_COMMAND, timeout=.1, halt_on_failure=True,
+                logger=LoggerReplacement()
+            )
+        )
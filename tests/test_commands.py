@@ -259,6 +259,80 @@ class TestCommand(unittest.TestCase):
         )
         self.assertRaises(ScriptHarnessError, command.run)
 
+    def test_add_lines(self):
+        """test_commands | Command.add_lines() batches
+        """
+        class BatchCommand(commands.Command):
+            """Keep track of the batches"""
+            batches = []
+
+            def add_lines(self, lines):
+                self.batches.append(lines)
+
+        command = BatchCommand(
+            [sys.executable, "-c", "print('foo');print('bar')"],
+            logger=LoggerReplacement()
+        )
+        command.run()
+        lines = [to_unicode(line).rstrip()
+                 for batch in command.batches for line in batch]
+        self.assertEqual(lines, ["foo", "bar"])
+        self.assertEqual(command.logger.all_messages[-1][1],
+                         command.strings["copy_paste"])
+
+    def test_encoding(self):
+        """test_commands | Command output decoding
+        """
+        code = ("import os;os.write(1, b'caf\\xc3');"
+                "os.write(1, b'\\xa9\\n\\xff\\n')")
+        command = get_command(command=[sys.executable, "-c", code],
+                              errors='replace')
+        command.run()
+        self.assertEqual(
+            [message[2][0] for message in command.logger.all_messages[-2:]],
+            ["caf\u00e9", "\ufffd"]
+        )
+        self.assertFalse('errors' in command.kwargs)
+
+        class BytesCommand(commands.Command):
+            """Keep track of the undecoded lines"""
+            lines = []
+
+            def add_line(self, line):
+                self.lines.append(line)
+
+        command = BytesCommand([sys.executable, "-c", code], encoding=None,
+                               logger=LoggerReplacement())
+        command.run()
+        self.assertEqual(command.lines, [b"caf\xc3\xa9", b"\xff"])
+
+    def test_command_id(self):
+        """test_commands | Command command_id in the log context
+        """
+        contexts = []
+
+        class ContextCommand(commands.Command):
+            """Keep track of the log context of each line"""
+            def add_line(self, line):
+                contexts.append(log.get_log_context())
+
+        command = ContextCommand([sys.executable, "-c", "print('foo')"],
+                                 logger=LoggerReplacement())
+        other = get_command()
+        self.assertNotEqual(command.command_id, other.command_id)
+        with log.log_context(action="build"):
+            command.run()
+        self.assertEqual(contexts, [
+            {'action': "build", 'command_id': command.command_id}
+        ])
+        self.assertEqual(log.get_log_context(), {})
+
+    def test_nonexistent_command(self):
+        """test_commands | Command nonexistent command
+        """
+        command = get_command(command=["this_command_should_not_exist"])
+        self.assertRaises(ScriptHarnessError, command.run)
+
     @mock.patch('scriptharness.commands.os')
     def test_fix_env(self, mock_os):
         """test_commands | Command.fix_env()
@@ -280,8 +354,8 @@ class TestCommand(unittest.TestCase):
 class TestRun(unittest.TestCase):
     """test commands.run()
     """
-    @mock.patch('scriptharness.commands.multiprocessing')
-    def test_error(self, mock_multiprocessing):
+    @mock.patch('scriptharness.commands.subprocess')
+    def test_error(self, mock_subprocess):
         """test_commands | run() error
         """
         def raise_error(*args, **kwargs):
@@ -289,14 +363,14 @@ class TestRun(unittest.TestCase):
             if args or kwargs:  # silence pylint
                 pass
             raise ScriptHarnessError("foo")
-        mock_multiprocessing.Process = raise_error
+        mock_subprocess.Popen = raise_error
         self.assertRaises(
             ScriptHarnessFatal, commands.run,
             "echo", halt_on_failure=True
         )
 
-    @mock.patch('scriptharness.commands.multiprocessing')
-    def test_timeout(self, mock_multiprocessing):
+    @mock.patch('scriptharness.commands.subprocess')
+    def test_timeout(self, mock_subprocess):
         """test_commands | run() timeout
         """
         def raise_error(*args, **kwargs):
@@ -304,14 +378,14 @@ class TestRun(unittest.TestCase):
             if args or kwargs:  # silence pylint
                 pass
             raise ScriptHarnessTimeout("foo")
-        mock_multiprocessing.Process = raise_error
+        mock_subprocess.Popen = raise_error
         self.assertRaises(
             ScriptHarnessFatal, commands.run,
             "echo", halt_on_failure=True
         )
 
-    @mock.patch('scriptharness.commands.multiprocessing')
-    def test_no_halt(self, mock_multiprocessing):
+    @mock.patch('scriptharness.commands.subprocess')
+    def test_no_halt(self, mock_subprocess):
         """test_commands | run() halt_on_error=False
         """
         def raise_error(*args, **kwargs):
@@ -319,11 +393,79 @@ class TestRun(unittest.TestCase):
             if args or kwargs:  # silence pylint
                 pass
             raise ScriptHarnessTimeout("foo")
-        mock_multiprocessing.Process = raise_error
+        mock_subprocess.Popen = raise_error
         cmd = commands.run("echo", halt_on_failure=False)
         self.assertEqual(cmd.history['status'], status.TIMEOUT)
 
 
+# TestRunParallel {{{1
+class TestRunParallel(unittest.TestCase):
+    """test commands.run_parallel()
+    """
+    def test_run_parallel(self):
+        """test_commands | run_parallel()
+        """
+        logger = LoggerReplacement()
+        command_list = [
+            [sys.executable, "-c",
+             "import time;print('%d');time.sleep(.2);print('%d')" % (num, num)]
+            for num in range(4)
+        ]
+        now = time.time()
+        status_, cmds = commands.run_parallel(command_list, workers=4,
+                                              logger=logger)
+        self.assertTrue(now + 1.5 > time.time())
+        self.assertEqual(status_, status.SUCCESS)
+        self.assertEqual([cmd.command for cmd in cmds], command_list)
+        output = [message[2][0] for message in logger.all_messages
+                  if message[1] == " %s"]
+        # Each command's output is contiguous.
+        for pos in range(0, 8, 2):
+            self.assertEqual(output[pos], output[pos + 1])
+
+    def test_instances(self):
+        """test_commands | run_parallel() with ParsedCommand objects
+        """
+        error_list = ErrorList([
+            {'substr': 'ell', 'level': logging.WARNING}
+        ])
+        parser_logger = LoggerReplacement()
+        parser = log.OutputParser(error_list, logger=parser_logger)
+        cmd = get_parsed_command(parser=parser)
+        status_, cmds = commands.run_parallel([cmd, get_command()])
+        self.assertEqual(status_, status.SUCCESS)
+        self.assertTrue(cmds[0] is cmd)
+        self.assertTrue(parser.logger is parser_logger)
+        self.assertEqual(parser_logger.all_messages,
+                         [(logging.WARNING, ' hello', ())])
+
+    def test_aggregate_status(self):
+        """test_commands | run_parallel() aggregate status
+        """
+        command_list = [
+            TEST_COMMAND, [sys.executable, "-c", "import sys;sys.exit(1)"]
+        ]
+        status_, cmds = commands.run_parallel(command_list, workers=2,
+                                              logger=LoggerReplacement())
+        self.assertEqual(status_, status.ERROR)
+        self.assertEqual(cmds[0].history['status'], status.SUCCESS)
+        self.assertEqual(cmds[1].history['status'], status.ERROR)
+
+    def test_halt_on_failure(self):
+        """test_commands | run_parallel() halt_on_failure
+        """
+        command_list = [[sys.executable, "-c", "import sys;sys.exit(1)"]] + \
+            [TEST_COMMAND] * 3
+        cmds = [get_command(command=command) for command in command_list]
+        self.assertRaises(
+            ScriptHarnessFatal, commands.run_parallel, cmds, workers=1,
+            halt_on_failure=True
+        )
+        self.assertEqual(cmds[0].history['status'], status.ERROR)
+        for cmd in cmds[1:]:
+            self.assertFalse('status' in cmd.history)
+
+
 # TestParsedCommand {{{1
 class TestParsedCommand(unittest.TestCase):
     """ParsedCommand()
@@ -414,6 +556,18 @@ class TestOutput(unittest.TestCase):
                 self.assertRaises(ScriptHarnessTimeout, command.run)
                 self.assertTrue(now + 1 > time.time())
 
+    def test_separate_streams(self):
+        """test_commands | Output stdout and stderr go to separate files
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("out");sys.stderr.write("err")'
+        ]
+        with get_output(command=cmd) as command:
+            command.run()
+            self.assertEqual(command.get_output(), "out")
+            self.assertEqual(command.get_output(handle_name="stderr"), "err")
+
     def test_get_output_exception(self):
         """test_commands | Output.get_output() exception
         """
@@ -434,6 +588,100 @@ class TestOutput(unittest.TestCase):
                 "hello"
             )
 
+    def test_iter_lines(self):
+        """test_commands | Output.iter_lines()
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("one\\r\\ntwo \\n\\nthree");'
+            'sys.stderr.write("err\\n")'
+        ]
+        with get_output(command=cmd) as command:
+            command.run()
+            self.assertEqual(list(command.iter_lines()),
+                             ["one", "two ", "", "three"])
+            self.assertEqual(list(command.iter_lines(text=False)),
+                             [b"one\r\n", b"two \n", b"\n", b"three"])
+            self.assertEqual(list(command.iter_lines(handle_name="stderr")),
+                             ["err"])
+            self.assertRaises(ScriptHarnessException, list,
+                              command.iter_lines(handle_name="foo"))
+
+    def test_iter_chunks(self):
+        """test_commands | Output.iter_chunks()
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import os;os.write(1, bytes(bytearray(range(256))) * 10)'
+        ]
+        with get_output(command=cmd) as command:
+            command.run()
+            chunks = list(command.iter_chunks(chunk_size=1000))
+            self.assertEqual([len(chunk) for chunk in chunks],
+                             [1000, 1000, 560])
+            self.assertEqual(b"".join(chunks),
+                             bytes(bytearray(range(256))) * 10)
+            self.assertEqual(list(command.iter_chunks(handle_name="stderr")),
+                             [])
+
+    def test_mmap_output(self):
+        """test_commands | Output.mmap_output()
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("foo bar baz")'
+        ]
+        with get_output(command=cmd) as command:
+            command.run()
+            with command.mmap_output() as view:
+                self.assertEqual(len(view), 11)
+                self.assertEqual(view.find(b"bar"), 4)
+                self.assertEqual(view[8:], b"baz")
+            self.assertTrue(view.closed)
+            with command.mmap_output(handle_name="stderr") as view:
+                self.assertEqual(view, b"")
+
+    def test_spool_in_memory(self):
+        """test_commands | Output spool_size in memory
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("one\\ntwo\\n");'
+            'sys.stderr.write("err")'
+        ]
+        with get_output(command=cmd, spool_size=1024) as command:
+            self.assertFalse('spool_size' in command.kwargs)
+            command.run()
+            self.assertTrue(command.stdout.name is None)
+            self.assertTrue(command.get_output_path() is None)
+            self.assertEqual(command.get_output(), "one\ntwo")
+            self.assertEqual(command.get_output(text=False), b"one\ntwo\n")
+            self.assertEqual(command.get_output(handle_name="stderr"), "err")
+            self.assertEqual(list(command.iter_lines()), ["one", "two"])
+            self.assertEqual(list(command.iter_chunks(chunk_size=3)),
+                             [b"one", b"\ntw", b"o\n"])
+            with command.mmap_output() as view:
+                self.assertEqual(view, b"one\ntwo\n")
+
+    def test_spool_spill(self):
+        """test_commands | Output spool_size spills to a file
+        """
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("x" * 5000)'
+        ]
+        with get_output(command=cmd, spool_size=1000) as command:
+            command.run()
+            path = command.stdout.name
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(command.stderr.name is None)
+            self.assertEqual(command.get_output(), "x" * 5000)
+            self.assertRaises(ScriptHarnessException,
+                              command.stdout.getvalue)
+            with command.mmap_output() as view:
+                self.assertEqual(len(view), 5000)
+        self.assertFalse(os.path.exists(path))
+
     def test_nonexistent_command(self):
         """test_commands | Output nonexistent command
         """
@@ -441,6 +689,87 @@ class TestOutput(unittest.TestCase):
             self.assertRaises(ScriptHarnessError, command.run)
 
 
+# ParsedOutput {{{1
+class TestParsedOutput(unittest.TestCase):
+    """Test ParsedOutput()
+    """
+    def test_no_error_list(self):
+        """test_commands | ParsedOutput bad error_list
+        """
+        self.assertRaises(ScriptHarnessException, commands.ParsedOutput,
+                          TEST_COMMAND, error_list=[])
+        parser = log.OutputParser(ErrorList([]))
+        self.assertRaises(ScriptHarnessException, commands.ParsedOutput,
+                          TEST_COMMAND, stdout_parser=parser)
+
+    def test_tee(self):
+        """test_commands | ParsedOutput tees to files and parsers
+        """
+        error_list = ErrorList([
+            {'substr': 'oops', 'level': logging.ERROR},
+            {'substr': 'careful', 'level': logging.WARNING},
+        ])
+        stdout_logger = LoggerReplacement()
+        stderr_logger = LoggerReplacement()
+        cmd = [
+            sys.executable, "-c",
+            'import os;os.write(1, b"fine\\n\\xff\\x00oops\\nlast");'
+            'os.write(2, b"careful\\n")'
+        ]
+        command = commands.ParsedOutput(
+            cmd, logger=LoggerReplacement(),
+            stdout_parser=log.OutputParser(error_list, logger=stdout_logger),
+            stderr_parser=log.OutputParser(error_list, logger=stderr_logger),
+            errors='replace',
+        )
+        try:
+            self.assertRaises(ScriptHarnessError, command.run)
+            self.assertEqual(command.history['status'], status.ERROR)
+            self.assertEqual(command.get_output(text=False),
+                             b"fine\n\xff\x00oops\nlast")
+            self.assertEqual(command.get_output(handle_name="stderr"),
+                             "careful")
+        finally:
+            command.cleanup()
+        self.assertEqual(stdout_logger.all_messages, [
+            (logging.INFO, ' fine', ()),
+            (logging.ERROR, ' �\x00oops', ()),
+            (logging.INFO, ' last', ()),
+        ])
+        self.assertEqual(stderr_logger.all_messages, [
+            (logging.WARNING, ' careful', ()),
+        ])
+        self.assertEqual(command.parsers['stdout'].history['num_errors'], 1)
+        self.assertEqual(command.parsers['stderr'].history['num_errors'], 0)
+        self.assertEqual(
+            command.parsers['stderr'].history['num_warnings'], 1
+        )
+
+    def test_run_parallel(self):
+        """test_commands | ParsedOutput run_parallel buffers both parsers
+        """
+        logger = LoggerReplacement()
+        cmd = [
+            sys.executable, "-c",
+            'import sys;sys.stdout.write("out\\n");sys.stderr.write("err\\n")'
+        ]
+        error_list = ErrorList([{'substr': 'err', 'level': logging.WARNING}])
+        command = commands.ParsedOutput(
+            cmd, logger=logger,
+            stdout_parser=log.OutputParser(error_list, logger=logger),
+            stderr_parser=log.OutputParser(error_list, logger=logger),
+        )
+        try:
+            result, _ = commands.run_parallel([command])
+        finally:
+            command.cleanup()
+        self.assertEqual(result, status.SUCCESS)
+        messages = [message for _, message, _ in logger.all_messages]
+        self.assertTrue(' out' in messages)
+        self.assertTrue(' err' in messages)
+        self.assertTrue(command.parsers['stdout'].logger is logger)
+
+
 # TestGetOutput {{{1
 class TestGetOutput(unittest.TestCase):
     """test commands.get_output() and get_text_output()
@@ -478,6 +807,20 @@ class TestGetOutput(unittest.TestCase):
             "echo", halt_on_failure=True
         )
 
+    def test_text_output_no_files(self):
+        """test_commands | get_text_output() doesn't create temp files
+        """
+        logger = LoggerReplacement()
+        cmd = [sys.executable, "-c", 'print("foo\\nbar")']
+        with mock.patch('scriptharness.commands.tempfile') as mock_tempfile:
+            output = commands.get_text_output(cmd, logger=logger)
+            self.assertFalse(mock_tempfile.NamedTemporaryFile.called)
+        self.assertEqual(output, "foo\nbar")
+        self.assertEqual(
+            [message for _, message, _ in logger.all_messages[-3:]],
+            ["Got output:", " foo", " bar"]
+        )
+
     @mock.patch('scriptharness.commands.subprocess')
     def test_no_halt(self, mock_subprocess):
         """test_commands | get_output() halt_on_error=False
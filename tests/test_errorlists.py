@@ -11,7 +11,7 @@ Attributes:
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import re
-from scriptharness.errorlists import ErrorList
+from scriptharness.errorlists import ErrorList, get_required_literal
 from scriptharness.exceptions import ScriptHarnessException
 import unittest
 
@@ -83,3 +83,51 @@ class TestErrorList(unittest.TestCase):
             self.assertRaises(
                 ScriptHarnessException, ErrorList, error_list
             )
+
+    def test_match(self):
+        """test_log | ErrorList match()
+        """
+        error_list = ErrorList([
+            {'substr': 'baz', 'level': 1},
+            {'regex': re.compile(r'^foo'), 'level': 2},
+            {'substr': 'foo', 'level': 3},
+            {'regex': re.compile(r'ba[rz]'), 'level': 4},
+        ])
+        self.assertTrue(error_list.match("nothing here") is None)
+        self.assertEqual(error_list.match("foo")['level'], 2)
+        self.assertEqual(error_list.match("x foo")['level'], 3)
+        self.assertEqual(error_list.match("foo bar")['level'], 2)
+        # The first error_check wins, even though it matches later in the
+        # line than the others
+        self.assertEqual(error_list.match("foo bar baz")['level'], 1)
+        self.assertEqual(error_list.match("x bar")['level'], 4)
+        self.assertTrue(ErrorList([]).match("foo") is None)
+
+    def test_required_literal(self):
+        """test_log | get_required_literal()
+        """
+        for pattern, flags, expected in (
+                (r':\d+: error:', 0, ': error:'),
+                (r'make\[\d+\]: \*\*\* \[.*\] Error \d+', 0, ']: *** ['),
+                (r'abc?def', 0, 'def'),
+                (r'(foo|bar)', 0, None),
+                (r'\d+', 0, None),
+                (r'error', re.IGNORECASE, None),
+                (r'(?i)error', 0, None)):
+            self.assertEqual(
+                get_required_literal(re.compile(pattern, flags)), expected
+            )
+        self.assertTrue(get_required_literal(re.compile(b'foo')) is None)
+
+    def test_match_prefilter(self):
+        """test_log | ErrorList match() with required literals
+        """
+        error_list = ErrorList([
+            {'regex': re.compile(r'\d+: error:'), 'level': 1},
+            {'regex': re.compile(r'(?i)warning'), 'level': 2},
+        ])
+        self.assertEqual(error_list.searches[0][0], ': error:')
+        self.assertTrue(error_list.searches[1][0] is None)
+        self.assertTrue(error_list.match("x: error: y") is None)
+        self.assertEqual(error_list.match("x:12: error: y")['level'], 1)
+        self.assertEqual(error_list.match("WARNING: error:")['level'], 2)
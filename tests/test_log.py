@@ -12,6 +12,7 @@ from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import codecs
 from contextlib import contextmanager
+import json
 import logging
 import mock
 import os
@@ -22,6 +23,8 @@ from scriptharness.exceptions import ScriptHarnessException, \
     ScriptHarnessError
 import scriptharness.log as log
 import six
+import sys
+import threading
 import unittest
 from . import UNICODE_STRINGS, LOGGER_NAME, LoggerReplacement, \
               stdstar_redirected
@@ -79,6 +82,54 @@ def always_succeed_cb(*args):
     return False
 
 
+# TestCachedFormatter {{{1
+class TestCachedFormatter(unittest.TestCase):
+    """Test scriptharness.log.CachedFormatter
+    """
+    @staticmethod
+    def get_record(created, msg="foo %s", args=("bar", ), exc_info=None):
+        """Create a LogRecord at a given time."""
+        record = logging.LogRecord(LOGGER_NAME, logging.INFO, __file__, 1,
+                                   msg, args, exc_info)
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        return record
+
+    def test_same_output(self):
+        """test_log | CachedFormatter matches UnicodeFormatter
+        """
+        try:
+            raise ValueError("x")
+        except ValueError:
+            exc_info = sys.exc_info()
+        for fmt, datefmt in ((log.DEFAULT_FMT, log.DEFAULT_DATEFMT),
+                             ('%(asctime)s %(message)s', None),
+                             ('%(levelname)s - %(message)s', None)):
+            formatter = log.UnicodeFormatter(fmt=fmt, datefmt=datefmt)
+            cached = log.get_formatter(fmt=fmt, datefmt=datefmt, cached=True)
+            for created in (1000.1, 1000.9, 1001.5, 1001.6):
+                self.assertEqual(cached.format(self.get_record(created)),
+                                 formatter.format(self.get_record(created)))
+            self.assertEqual(
+                cached.format(self.get_record(1002., exc_info=exc_info)),
+                formatter.format(self.get_record(1002., exc_info=exc_info))
+            )
+
+    @mock.patch('scriptharness.log.time')
+    def test_cache(self, mock_time):
+        """test_log | CachedFormatter caches the time per second
+        """
+        mock_time.strftime.return_value = "12:34:56"
+        formatter = log.CachedFormatter(fmt='%(asctime)s %(message)s',
+                                        datefmt=log.DEFAULT_DATEFMT)
+        for created in (1000.1, 1000.2, 1000.9):
+            self.assertEqual(formatter.format(self.get_record(created)),
+                             "12:34:56 foo bar")
+        self.assertEqual(mock_time.strftime.call_count, 1)
+        formatter.format(self.get_record(1001.))
+        self.assertEqual(mock_time.strftime.call_count, 2)
+
+
 # TestPrepareSimpleLogging {{{1
 class TestPrepareSimpleLogging(unittest.TestCase):
     """Test scriptharness.log.prepare_simple_logging() method
@@ -98,6 +149,98 @@ class TestPrepareSimpleLogging(unittest.TestCase):
         file_mock.assert_called_once_with(log.DEFAULT_LEVEL)
 
 
+# TestQueueHandler {{{1
+class TestQueueHandler(unittest.TestCase):
+    """Test scriptharness.log.QueueHandler
+    """
+    @staticmethod
+    def get_logger(handler):
+        """Return a logger that only logs to handler."""
+        logger = logging.getLogger("%s.queue" % LOGGER_NAME)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        for old_handler in list(logger.handlers):
+            logger.removeHandler(old_handler)
+        logger.addHandler(handler)
+        return logger
+
+    def test_queue_handler(self):
+        """test_log | QueueHandler sends records to its handlers
+        """
+        records = []
+        target = logging.Handler(level=logging.INFO)
+        target.emit = records.append
+        handler = log.get_queue_handler([target], level=logging.DEBUG)
+        logger = self.get_logger(handler)
+        args = {'x': 1}
+        logger.info("foo %(x)s", args)
+        args['x'] = 2
+        logger.debug("debug")
+        handler.flush()
+        self.assertEqual([record.getMessage() for record in records],
+                         ["foo 1"])
+        handler.close()
+        self.assertFalse(handler.thread.is_alive())
+        logger.removeHandler(handler)
+
+    def test_overflow_drop(self):
+        """test_log | QueueHandler OVERFLOW_DROP
+        """
+        records = []
+        release = threading.Event()
+        target = logging.Handler()
+
+        def slow_emit(record):
+            """Block until the test fills the queue."""
+            release.wait(10)
+            records.append(record.getMessage())
+
+        target.emit = slow_emit
+        handler = log.QueueHandler([target], queue_size=2,
+                                   overflow=log.OVERFLOW_DROP)
+        logger = self.get_logger(handler)
+        for num in range(10):
+            logger.info("info %d", num)
+        self.assertTrue(handler.dropped > 0)
+        release.set()
+        logger.warning("warning")
+        handler.close()
+        logger.removeHandler(handler)
+        self.assertTrue("warning" in records)
+        self.assertEqual(
+            len([record for record in records
+                 if record.startswith("Dropped ")]), 1
+        )
+        self.assertTrue(len(records) < 12)
+        self.assertEqual(handler.dropped, 0)
+
+    def test_bad_overflow(self):
+        """test_log | QueueHandler unknown overflow
+        """
+        self.assertRaises(ScriptHarnessException, log.QueueHandler, [],
+                          overflow="unknown")
+
+    def test_prepare_simple_logging(self):
+        """test_log | prepare_simple_logging use_queue
+        """
+        path = _absent_test_file()
+        logger = log.prepare_simple_logging(
+            path, logger_name="%s.prepare_queue" % LOGGER_NAME,
+            use_queue=True
+        )
+        self.assertEqual(len(logger.handlers), 1)
+        handler = logger.handlers[0]
+        self.assertTrue(isinstance(handler, log.QueueHandler))
+        logger.info(TEST_STRING)
+        handler.close()
+        logger.removeHandler(handler)
+        for target in handler.handlers:
+            target.close()
+        with open(path) as filehandle:
+            self.assertTrue(TEST_STRING in filehandle.read())
+        os.remove(path)
+
+
 # TestGetFileHandler {{{1
 class TestGetFileHandler(unittest.TestCase):
     """test_log | scriptharness.log.get_file_handler() method
@@ -135,6 +278,226 @@ class TestGetFileHandler(unittest.TestCase):
             self.assertEqual(line, TEST_STRING)
 
 
+# TestBufferedFileHandler {{{1
+class TestBufferedFileHandler(unittest.TestCase):
+    """Test scriptharness.log.BufferedFileHandler
+    """
+    def tearDown(self):
+        assert self  # silence pylint
+        if os.path.exists(TEST_FILE):
+            os.remove(TEST_FILE)
+
+    @staticmethod
+    def get_logger(handler):
+        """Return a logger that only logs to handler."""
+        handler.setFormatter(logging.Formatter(fmt='%(message)s'))
+        logger = logging.getLogger("%s.buffered" % LOGGER_NAME)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        for old_handler in list(logger.handlers):
+            logger.removeHandler(old_handler)
+        logger.addHandler(handler)
+        return logger
+
+    @staticmethod
+    def read_log():
+        """Return the contents of TEST_FILE."""
+        with open(TEST_FILE) as filehandle:
+            return filehandle.read()
+
+    def test_buffer_size(self):
+        """test_log | BufferedFileHandler writes when the buffer is full
+        """
+        handler = log.get_file_handler(_absent_test_file(), buffered=True)
+        handler.buffer_size = 10
+        handler.flush_interval = 1000
+        logger = self.get_logger(handler)
+        logger.info("foo")
+        self.assertEqual(self.read_log(), "")
+        logger.info("bar baz")
+        self.assertEqual(self.read_log(), "foo\nbar baz\n")
+        logger.info("x")
+        handler.close()
+        logger.removeHandler(handler)
+        self.assertEqual(self.read_log(), "foo\nbar baz\nx\n")
+
+    def test_flush_level(self):
+        """test_log | BufferedFileHandler writes errors immediately
+        """
+        handler = log.BufferedFileHandler(_absent_test_file(), mode='w',
+                                          flush_interval=1000)
+        logger = self.get_logger(handler)
+        logger.info("foo")
+        logger.error("bar")
+        self.assertEqual(self.read_log(), "foo\nbar\n")
+        logger.removeHandler(handler)
+        handler.close()
+
+    def test_flush_interval(self):
+        """test_log | BufferedFileHandler writes after flush_interval
+        """
+        handler = log.BufferedFileHandler(_absent_test_file(), mode='w')
+        logger = self.get_logger(handler)
+        logger.info("foo")
+        self.assertEqual(self.read_log(), "")
+        handler.last_flush -= log.DEFAULT_FLUSH_INTERVAL
+        logger.info("bar")
+        self.assertEqual(self.read_log(), "foo\nbar\n")
+        logger.info("baz")
+        log.flush_handlers(logger)
+        self.assertEqual(self.read_log(), "foo\nbar\nbaz\n")
+        logger.removeHandler(handler)
+        handler.close()
+
+    def test_rotation(self):
+        """test_log | BufferedFileHandler rotation
+        """
+        handler = log.get_file_handler(_absent_test_file(), buffered=True,
+                                       max_bytes=8, backup_count=2)
+        handler.buffer_size = 1
+        logger = self.get_logger(handler)
+        for string in ("one", "two", "three", "four", "five", "six"):
+            logger.info(string)
+        logger.removeHandler(handler)
+        handler.close()
+        self.assertFalse(os.path.exists(TEST_FILE))
+        with open("%s.1" % TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "five\nsix\n")
+        with open("%s.2" % TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "three\nfour\n")
+        self.assertFalse(os.path.exists("%s.3" % TEST_FILE))
+        # mode 'w' rotates the previous log rather than truncating it
+        _present_test_file(contents=True)
+        handler = log.get_file_handler(TEST_FILE, backup_count=2)
+        handler.close()
+        with open("%s.1" % TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read().rstrip(), TEST_FILE_CONTENTS)
+        with open("%s.2" % TEST_FILE) as filehandle:
+            self.assertEqual(filehandle.read(), "five\nsix\n")
+        for num in (1, 2):
+            os.remove("%s.%d" % (TEST_FILE, num))
+
+# TestCompressedFileHandler {{{1
+class TestCompressedFileHandler(unittest.TestCase):
+    """Test scriptharness.log.CompressedFileHandler and open_log()
+    """
+    def tearDown(self):
+        assert self  # silence pylint
+        if os.path.exists(TEST_FILE):
+            os.remove(TEST_FILE)
+
+    def write_log(self, **kwargs):
+        """Log some lines to TEST_FILE, then return the raw bytes."""
+        handler = log.get_file_handler(
+            _absent_test_file(), formatter=logging.Formatter('%(message)s'),
+            **kwargs
+        )
+        logger = TestBufferedFileHandler.get_logger(handler)
+        for string in UNICODE_STRINGS:
+            logger.info(string)
+        logger.removeHandler(handler)
+        handler.close()
+        with open(TEST_FILE, 'rb') as filehandle:
+            contents = filehandle.read()
+        with log.open_log(TEST_FILE) as filehandle:
+            self.assertEqual(
+                [line.rstrip('\n') for line in filehandle],
+                list(UNICODE_STRINGS)
+            )
+        return contents
+
+    def test_compression(self):
+        """test_log | CompressedFileHandler and open_log()
+        """
+        self.assertFalse(self.write_log().startswith(log.GZIP_MAGIC))
+        self.assertTrue(
+            self.write_log(compression=log.COMPRESSION_GZIP,
+                           compress_level=1).startswith(log.GZIP_MAGIC)
+        )
+        if log.lzma is not None:
+            self.assertTrue(
+                self.write_log(compression=log.COMPRESSION_LZMA)
+                .startswith(log.LZMA_MAGIC)
+            )
+
+    def test_bad_compression(self):
+        """test_log | open_compressed() unknown compression
+        """
+        self.assertRaises(ScriptHarnessException, log.open_compressed,
+                          TEST_FILE, 'w', compression="unknown")
+
+
+# TestJsonFormatter {{{1
+class TestJsonFormatter(unittest.TestCase):
+    """Test scriptharness.log.JsonFormatter and the log context
+    """
+    def tearDown(self):
+        assert self  # silence pylint
+        if os.path.exists(TEST_FILE):
+            os.remove(TEST_FILE)
+
+    def test_log_context(self):
+        """test_log | log_context()
+        """
+        self.assertEqual(log.get_log_context(), {})
+        with log.log_context(action="one"):
+            with log.log_context(command_id=3):
+                self.assertEqual(log.get_log_context(),
+                                 {'action': "one", 'command_id': 3})
+            self.assertEqual(log.get_log_context(), {'action': "one"})
+        self.assertEqual(log.get_log_context(), {})
+
+    def test_json_handler(self):
+        """test_log | get_json_handler()
+        """
+        handler = log.get_json_handler(_absent_test_file())
+        logger = TestBufferedFileHandler.get_logger(handler)
+        handler.setFormatter(log.JsonFormatter())
+        with log.log_context(action="build"):
+            logger.info("foo %s", UNICODE_STRINGS[1])
+            with log.log_context(command_id=7):
+                logger.warning("bar")
+            try:
+                raise ValueError("baz")
+            except ValueError:
+                logger.exception("oops")
+        logger.info("done")
+        logger.removeHandler(handler)
+        handler.close()
+        with open(TEST_FILE, 'rb') as filehandle:
+            lines = [json.loads(line.decode('utf-8'))
+                     for line in filehandle]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0]['message'], "foo %s" % UNICODE_STRINGS[1])
+        self.assertEqual(lines[0]['level'], "INFO")
+        self.assertEqual(lines[0]['action'], "build")
+        self.assertFalse('command_id' in lines[0])
+        self.assertEqual(lines[1]['command_id'], 7)
+        self.assertTrue("ValueError: baz" in lines[2]['exception'])
+        self.assertFalse('action' in lines[3])
+        self.assertEqual(lines[3]['logger'], "%s.buffered" % LOGGER_NAME)
+        self.assertTrue(lines[0]['monotonic'] <= lines[3]['monotonic'])
+        for line in lines:
+            self.assertEqual(
+                sorted(set(line) - set(log.JSON_CONTEXT_KEYS) -
+                       set(['exception'])),
+                ['level', 'lineno', 'logger', 'message', 'monotonic', 'time']
+            )
+
+    def test_buffered_logger_context(self):
+        """test_log | BufferedLogger keeps the log context
+        """
+        logger = mock.MagicMock()
+        buf = log.BufferedLogger(logger)
+        with log.log_context(command_id=4):
+            buf.info("foo", extra={'action': "x"})
+        buf.flush()
+        extra = logger.log.call_args[1]['extra']
+        self.assertEqual(extra['command_id'], 4)
+        self.assertEqual(extra['action'], "x")
+        self.assertTrue('monotonic' in extra)
+
+
 # TestGetConsoleHandler {{{1
 class TestGetConsoleHandler(unittest.TestCase):
     """test_log | scriptharness.log.get_console_handler() method
@@ -562,6 +925,30 @@ class TestUnicode(unittest.TestCase):
                 self.assertEqual(string, console_fh.read().rstrip())
 
 
+# TestBufferedLogger {{{1
+class TestBufferedLogger(unittest.TestCase):
+    """Test BufferedLogger.
+    """
+    def test_flush(self):
+        """test_log | BufferedLogger flush
+        """
+        logger1 = LoggerReplacement()
+        logger2 = LoggerReplacement()
+        records = []
+        buf1 = log.BufferedLogger(logger1, records=records)
+        buf2 = log.BufferedLogger(logger2, records=records)
+        buf1.info("foo %s", "a")
+        buf2.warning("bar")
+        buf1.log(logging.ERROR, "baz")
+        self.assertEqual(logger1.all_messages, [])
+        buf2.flush()
+        self.assertEqual(records, [])
+        self.assertEqual(logger1.all_messages, [
+            (logging.INFO, "foo %s", ("a", )), (logging.ERROR, "baz", ()),
+        ])
+        self.assertEqual(logger2.all_messages, [(logging.WARNING, "bar", ())])
+
+
 # TestOutputBuffer {{{1
 class TestOutputBuffer(unittest.TestCase):
     """Test OutputBuffer.
@@ -617,6 +1004,47 @@ class TestOutputBuffer(unittest.TestCase):
         self.assertEqual(logger.all_messages[4], (10, "y", ()))
         self.assertEqual(logger.all_messages[5], (0, "z", ()))
 
+    @mock.patch('scriptharness.log.logging')
+    def test_overlapping_context_lines(self, mock_logging):
+        """test_log | OutputBuffer overlapping context lines
+        """
+        logger = LoggerReplacement()
+        mock_logging.getLogger.return_value = logger
+        buf = log.OutputBuffer(logger, 1000, 4)
+        for num in range(2000):
+            buf.add_line(0, "line%d" % num)
+        self.assertEqual(len(buf.buffer), 1000)
+        self.assertEqual(len(logger.all_messages), 1000)
+        buf.add_line(10, "a", pre_context_lines=2, post_context_lines=4)
+        buf.add_line(20, "b", pre_context_lines=1, post_context_lines=1)
+        buf.add_line(0, "c")
+        buf.add_line(0, "d")
+        buf.add_line(0, "e")
+        buf.add_line(0, "f")
+        buf.dump_buffer()
+        self.assertEqual(len(buf.buffer), 0)
+        self.assertEqual(
+            logger.all_messages[-9:],
+            [(0, "line1997", ()), (10, "line1998", ()),
+             (10, "line1999", ()), (20, "a", ()), (20, "b", ()),
+             (20, "c", ()), (10, "d", ()), (10, "e", ()), (0, "f", ())]
+        )
+
+    def test_timestamps(self):
+        """test_log | OutputBuffer timestamps
+        """
+        logger = mock.MagicMock()
+        buf = log.OutputBuffer(logger, 3, 0)
+        buf.add_line(0, "foo")
+        self.assertTrue(isinstance(buf.buffer[0], log.BufferedLine))
+        self.assertTrue(buf.buffer[0].time is not None)
+        self.assertFalse(hasattr(buf.buffer[0], '__dict__'))
+        buf = log.OutputBuffer(logger, 3, 0, timestamps=False)
+        buf.add_line(0, "foo")
+        self.assertTrue(buf.buffer[0].time is None)
+        buf.dump_buffer()
+        logger.log.assert_called_once_with(0, "foo")
+
 
 # TestOutputParser {{{1
 class TestOutputParser(unittest.TestCase):
@@ -632,6 +1060,35 @@ class TestOutputParser(unittest.TestCase):
             **kwargs
         )
 
+    def test_context_buffer_logger(self):
+        """test_log | OutputParser context buffer uses the parser's logger
+        """
+        error_list = ErrorList([
+            {'substr': 'foo', 'level': logging.WARNING,
+             'pre_context_lines': 2},
+        ])
+        parser = log.OutputParser(error_list, timestamps=False)
+        self.assertTrue(parser.context_buffer.logger is parser.logger)
+        self.assertFalse(parser.context_buffer.timestamps)
+
+    def test_add_buffer_list(self):
+        """test_log | OutputParser add_buffer() with a list of messages
+        """
+        error_list = ErrorList([{'substr': 'foo', 'level': logging.ERROR}])
+        parser1 = self.get_output_parser(error_list)
+        parser1.add_buffer(logging.ERROR, " one\n two")
+        parser2 = self.get_output_parser(error_list)
+        parser2.add_buffer(logging.ERROR, [" one", " two"])
+        self.assertEqual(parser1.logger.all_messages,
+                         parser2.logger.all_messages)
+        self.assertEqual(len(parser2.logger.all_messages), 2)
+        self.assertEqual(parser2.history['num_errors'], 1)
+        parser3 = self.get_output_parser(error_list)
+        parser3.add_line(b"bar\n")
+        self.assertEqual(parser3.logger.all_messages,
+                         [(logging.INFO, " bar", ())])
+        self.assertEqual(parser3.history['worst_level'], logging.INFO)
+
     def test_simple_add_line(self):
         """test_log | OutputParser simple add_line()
         """
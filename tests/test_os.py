@@ -64,3 +64,21 @@ class TestFunctions(unittest.TestCase):
         # This should also be noop.  Boo hardcoded string.
         sh_os.makedirs(TEST_DIR, context=context)
         self.assertEqual(context.logger.all_messages[-1][1], "Already exists.")
+
+    def test_rotate_file(self):
+        """test_os | rotate_file()
+        """
+        os.makedirs(TEST_DIR)
+        path = os.path.join(TEST_DIR, "file")
+        sh_os.rotate_file(path, 2)
+        self.assertEqual(os.listdir(TEST_DIR), [])
+        for num in range(4):
+            with open(path, 'w') as filehandle:
+                filehandle.write("%d" % num)
+            sh_os.rotate_file(path, 2)
+        self.assertEqual(sorted(os.listdir(TEST_DIR)), ["file.1", "file.2"])
+        for name, contents in (("file.1", "3"), ("file.2", "2")):
+            with open(os.path.join(TEST_DIR, name)) as filehandle:
+                self.assertEqual(filehandle.read(), contents)
+        sh_os.rotate_file(os.path.join(TEST_DIR, "file.1"), 0)
+        self.assertTrue(os.path.exists(os.path.join(TEST_DIR, "file.1")))
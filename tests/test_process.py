@@ -5,12 +5,14 @@
 from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import mock
+import multiprocessing
 import os
 import psutil
 from scriptharness.exceptions import ScriptHarnessError, ScriptHarnessFatal
 import scriptharness.process as shprocess
 from scriptharness.unicode import to_unicode
 from six.moves.queue import Queue
+import subprocess
 import sys
 import unittest
 
@@ -84,6 +86,109 @@ class TestProcess(unittest.TestCase):
             ScriptHarnessError, shprocess.command_subprocess,
             queue, ["this_command_should_not_exist"],
         )
+        self.assertIs(queue.get(block=False), shprocess.END_OF_OUTPUT)
+
+    def test_watch_command(self):
+        """test_process | watch_command
+        """
+        queue = multiprocessing.Queue()
+        runner = multiprocessing.Process(
+            target=shprocess.command_subprocess,
+            args=(queue, [sys.executable, "-c",
+                          "import sys;print('foo');sys.exit(2)"]),
+        )
+        runner.start()
+        lines = []
+        logger = mock.MagicMock()
+        self.assertEqual(
+            shprocess.watch_command(logger, queue, runner, lines.append), 2
+        )
+        self.assertEqual([to_unicode(line).rstrip() for line in lines],
+                         ["foo"])
+
+    def test_batched_command_subprocess(self):
+        """test_process | batched_command_subprocess
+        """
+        queue = Queue()
+        self.assertRaises(
+            SystemExit, shprocess.batched_command_subprocess,
+            queue,
+            [sys.executable, "-c",
+             "import sys;sys.stdout.write('foo\\nbar\\nbaz')"],
+        )
+        lines = []
+        while True:
+            batch = queue.get(block=False)
+            if batch is shprocess.END_OF_OUTPUT:
+                break
+            self.assertTrue(isinstance(batch, list))
+            lines.extend(batch)
+        self.assertEqual([to_unicode(line) for line in lines],
+                         ["foo", "bar", "baz"])
+
+    def test_watch_command_batches(self):
+        """test_process | watch_command with batches
+        """
+        for add_lines_cb in (None, mock.MagicMock()):
+            queue = Queue()
+            queue.put(["foo", "bar"])
+            queue.put("baz")
+            queue.put(shprocess.END_OF_OUTPUT)
+            runner = mock.MagicMock()
+            runner.exitcode = 0
+            add_line_cb = mock.MagicMock()
+            shprocess.watch_command(mock.MagicMock(), queue, runner,
+                                    add_line_cb, add_lines_cb=add_lines_cb)
+            if add_lines_cb is None:
+                self.assertEqual(
+                    add_line_cb.call_args_list,
+                    [mock.call("foo"), mock.call("bar"), mock.call("baz")]
+                )
+            else:
+                add_lines_cb.assert_called_once_with(["foo", "bar"])
+                add_line_cb.assert_called_once_with("baz")
+
+    def test_watch_command_blocks(self):
+        """test_process | watch_command blocks until the nearest timeout
+        """
+        class FakeQueue(object):
+            """Record the get() timeouts"""
+            def __init__(self):
+                self.timeouts = []
+
+            def get(self, **kwargs):
+                """Return END_OF_OUTPUT after the first call"""
+                self.timeouts.append(kwargs['timeout'])
+                if len(self.timeouts) == 1:
+                    return "foo"
+                return shprocess.END_OF_OUTPUT
+        queue = FakeQueue()
+        runner = mock.MagicMock()
+        runner.exitcode = 0
+        self.assertEqual(
+            shprocess.watch_command(mock.MagicMock(), queue, runner,
+                                    mock.MagicMock(), max_timeout=30,
+                                    output_timeout=.5), 0
+        )
+        self.assertTrue(.4 < queue.timeouts[0] <= .5)
+        self.assertTrue(.4 < queue.timeouts[1] <= .5)
+        queue = FakeQueue()
+        shprocess.watch_command(mock.MagicMock(), queue, runner,
+                                mock.MagicMock())
+        self.assertEqual(queue.timeouts[0], shprocess.LIVENESS_INTERVAL)
+
+    def test_watch_command_dead_runner(self):
+        """test_process | watch_command runner dies without END_OF_OUTPUT
+        """
+        queue = Queue()
+        runner = mock.MagicMock()
+        runner.is_alive.return_value = False
+        runner.exitcode = -9
+        with mock.patch.object(shprocess, 'LIVENESS_INTERVAL', new=.01):
+            self.assertEqual(
+                shprocess.watch_command(mock.MagicMock(), queue, runner,
+                                        mock.MagicMock()), -9
+            )
 
     @mock.patch('scriptharness.process.psutil')
     def test_keyboard_interrupt(self, mock_psutil):
@@ -108,3 +213,102 @@ class TestProcess(unittest.TestCase):
             logger, queue, runner, add_line_cb
         )
         mock_psutil.Process.assert_called_once_with(os.getpid())
+
+
+# TestWatchPipe {{{1
+class TestWatchPipe(unittest.TestCase):
+    """Test the direct pipe reader.
+    """
+    @staticmethod
+    def get_process(code):
+        """Start a python process with stdout+stderr on a single pipe."""
+        return subprocess.Popen(
+            [sys.executable, "-c", code], stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, bufsize=0
+        )
+
+    def test_line_splitter(self):
+        """test_process | LineSplitter
+        """
+        splitter = shprocess.LineSplitter()
+        self.assertEqual(splitter.split(b"foo"), [])
+        self.assertEqual(splitter.split(b"bar\nbaz\nx"), [b"foobar", b"baz"])
+        self.assertEqual(splitter.split(b"\n"), [b"x"])
+        self.assertEqual(splitter.flush(), [])
+        splitter.split(b"partial")
+        self.assertEqual(splitter.flush(), [b"partial"])
+
+    def test_line_splitter_decode(self):
+        """test_process | LineSplitter incremental decoding
+        """
+        splitter = shprocess.LineSplitter(encoding='utf-8')
+        self.assertEqual(splitter.split(b"caf\xc3"), [])
+        self.assertEqual(splitter.split(b"\xa9\nna\xc3"), ["caf\u00e9"])
+        self.assertEqual(splitter.split(b"\xafve"), [])
+        self.assertEqual(splitter.flush(), ["na\u00efve"])
+        self.assertEqual(splitter.flush(), [])
+        splitter = shprocess.LineSplitter(encoding='utf-8')
+        splitter.split(b"\xc3")
+        self.assertRaises(UnicodeDecodeError, splitter.flush)
+        splitter = shprocess.LineSplitter(encoding='utf-8', errors='replace')
+        self.assertEqual(splitter.split(b"\xff\nx\xc3"), ["\ufffd"])
+        self.assertEqual(splitter.flush(), ["x\ufffd"])
+
+    def test_line_splitter_copy(self):
+        """test_process | LineSplitter.copy()
+        """
+        splitter = shprocess.LineSplitter(encoding='utf-8', errors='replace')
+        splitter.split(b"partial\xc3")
+        other = splitter.copy()
+        self.assertEqual((other.encoding, other.errors), ('utf-8', 'replace'))
+        self.assertEqual(other.split(b"\xa9\n"), ["\ufffd"])
+        self.assertEqual(splitter.split(b"\xa9\n"), ["partial\u00e9"])
+        self.assertEqual(shprocess.LineSplitter().copy().split(b"x\n"),
+                         [b"x"])
+
+    def test_watch_pipe(self):
+        """test_process | watch_pipe
+        """
+        lines = []
+        process = self.get_process(
+            "import sys;sys.stdout.write('foo\\nbar\\nbaz');"
+            "sys.stderr.write('\\n');sys.exit(3)"
+        )
+        logger = mock.MagicMock()
+        self.assertEqual(
+            shprocess.watch_pipe(logger, process, lines.append), 3
+        )
+        self.assertEqual(
+            [to_unicode(line).rstrip() for line in lines],
+            ["foo", "bar", "baz"]
+        )
+
+    @mock.patch('scriptharness.process.selectors', new=None)
+    def test_threaded_reader(self):
+        """test_process | watch_pipe with ThreadedReader
+        """
+        lines = []
+        process = self.get_process("print('foo');print('bar')")
+        logger = mock.MagicMock()
+        self.assertEqual(
+            shprocess.watch_pipe(logger, process, lines.append), 0
+        )
+        self.assertEqual(
+            [to_unicode(line).rstrip() for line in lines], ["foo", "bar"]
+        )
+
+    def test_keyboard_interrupt(self):
+        """test_process | watch_pipe KeyboardInterrupt
+        """
+        def raise_ki(_):
+            """Raise KeyboardInterrupt"""
+            raise KeyboardInterrupt()
+        process = self.get_process(
+            "import time;print('foo');time.sleep(300)"
+        )
+        logger = mock.MagicMock()
+        self.assertRaises(
+            ScriptHarnessFatal, shprocess.watch_pipe,
+            logger, process, raise_ki
+        )
+        self.assertIsNotNone(process.poll())
@@ -6,6 +6,8 @@ from __future__ import absolute_import, division, print_function, \
                        unicode_literals
 import argparse
 import json
+import logging
+import mock
 import os
 import scriptharness.actions as actions
 from scriptharness.config import get_config_template, update_dirs, \
@@ -272,6 +274,35 @@ class TestScript(unittest.TestCase):
         self.assertEqual(self.timings, ["one", "fatal", "post_fatal1",
                                         "post_fatal3"])
 
+    def test_config_backups(self):
+        """test_script | localconfig.json rotation
+        """
+        for _ in range(3):
+            self.get_script(initial_config={
+                'scriptharness_config_backups': 1
+            })
+        path = os.path.join("artifacts", "localconfig.json")
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(os.path.exists("%s.1" % path))
+        self.assertFalse(os.path.exists("%s.2" % path))
+
+    def test_flush_log_handlers(self):
+        """test_script | flush_log_handlers listeners
+        """
+        scr = self.get_script()
+        for phase in ("post_run", "post_fatal"):
+            self.assertTrue(
+                (script.flush_log_handlers, None) in scr.listeners[phase]
+            )
+        handler = mock.MagicMock()
+        handler.level = logging.NOTSET
+        scr.logger.addHandler(handler)
+        try:
+            scr.run()
+        finally:
+            scr.logger.removeHandler(handler)
+        self.assertTrue(handler.flush.called)
+
     def test_bad_phase_context(self):
         """test_script | bad phase build_context
         """